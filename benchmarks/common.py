@@ -0,0 +1,53 @@
+"""Measurement helpers shared by the benchmarks."""
+import json
+import os
+import subprocess
+import sys
+import threading
+
+
+def peak_rss_kb(children=False):
+    # With children, the peak of the largest terminated worker process
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_isolated(script, *args):
+    # Runs a benchmark mode in a fresh process, so peak RSS is not shared between modes
+    return json.loads(subprocess.check_output([sys.executable, os.path.abspath(script), *args]))
+
+
+def get_dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # Removed in between
+    return size
+
+
+class DirSizeSampler(threading.Thread):
+    """Samples the size of a directory in the background and keeps the peak."""
+
+    def __init__(self, path, interval=0.05):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak_bytes = max(self.peak_bytes, get_dir_size(self.path))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak_bytes = max(self.peak_bytes, get_dir_size(self.path))
+        return self.peak_bytes
@@ -0,0 +1,104 @@
+"""
+Compares the old temp-file embedding path with the in-memory path.
+
+Every mode runs in its own process, so the peak RSS of one mode does not leak into the other.
+
+    python benchmarks/embedding.py --images 200 --size 2000x1500
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from benchmarks.common import peak_rss_kb, run_isolated
+from core.imagePrep import prepare_image
+from core.pdfBuilder import PDFBuilder
+
+
+MODES = ("tempfile", "memory")
+
+
+def create_images(source_dir, count, size):
+    paths = []
+    for i in range(count):
+        ext = "jpg" if i % 2 else "png"
+        path = os.path.join(source_dir, f"img{i}.{ext}")
+        Image.effect_noise(size, 64 + i % 64).convert("RGB").save(path)
+        paths.append(path)
+    return paths
+
+
+def embed_tempfile(builder, path, ext):
+    # The original pipeline: resize, save to a temp file and let ReportLab read it back
+    with tempfile.NamedTemporaryFile(delete=False, suffix="." + ext, mode="w+b") as temp_file:
+        with Image.open(path) as img:
+            image_resized = img.resize((1000, round(1000 * img.width / img.height)))
+        image_resized.save(temp_file.name)
+        builder.canvas.drawImage(temp_file.name, 50, 50, width=500, height=375)
+    return temp_file.name
+
+
+def embed_memory(builder, path, ext):
+    builder.draw_image_stream(prepare_image(path, ext, (1000, 750)), 50, 50, 500, 375)
+
+
+def run_mode(mode, source_dir):
+    paths = sorted(os.path.join(source_dir, f) for f in os.listdir(source_dir))
+    output = io.BytesIO()
+    builder = PDFBuilder(output)
+    temp_files = []
+
+    start = time.perf_counter()
+    for path in paths:
+        ext = path.split(".")[-1]
+        if mode == "tempfile":
+            temp_files.append(embed_tempfile(builder, path, ext))
+        else:
+            embed_memory(builder, path, ext)
+        builder.next_page(apply_default_font=False)
+    builder.save()
+    seconds = time.perf_counter() - start
+
+    temp_bytes = sum(os.path.getsize(f) for f in temp_files)
+    for f in temp_files:
+        os.remove(f)
+
+    return {
+        "mode": mode,
+        "images": len(paths),
+        "seconds": round(seconds, 3),
+        "peak_rss_kb": peak_rss_kb(),
+        "temp_bytes": temp_bytes,
+        "output_bytes": len(output.getvalue()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=100)
+    parser.add_argument("--size", default="2000x1500")
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--source", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        print(json.dumps(run_mode(args.mode, args.source)))
+        return
+
+    size = tuple(int(i) for i in args.size.split("x"))
+    with tempfile.TemporaryDirectory() as source_dir:
+        create_images(source_dir, args.images, size)
+        results = [run_isolated(__file__, "--mode", mode, "--source", source_dir) for mode in MODES]
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
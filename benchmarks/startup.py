@@ -0,0 +1,110 @@
+"""
+Cold start of the application: time to the first window and time to the first page.
+
+Every measurement runs in a fresh interpreter and is taken from before the process is started, so it
+includes the interpreter startup and all imports, like a cold start of the executable.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --repeat 10 --output startup.json
+
+first_window needs a display, without one it is reported as null.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import run_isolated
+from benchmarks.suite import get_commit
+from benchmarks.synthetic import create_tree
+
+
+MEASUREMENTS = ("import", "first_window", "first_page")
+
+
+def measure(name, started, source_dir=None, output_file=None):
+    # Runs inside the fresh process, started is the wall clock time before it was spawned
+    if name == "import":
+        import main  # noqa: F401
+        return {"seconds": time.time() - started}
+
+    if name == "first_window":
+        import main
+        try:
+            app = main.IMG2PDFApplication()
+        except Exception as e:  # tkinter.TclError without a display
+            return {"seconds": None, "error": str(e)}
+        app.window.update()
+        seconds = time.time() - started
+        app.window.destroy()
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__  # Redirected to the console of the window
+        return {"seconds": seconds}
+
+    # The conversion of the window, including the import of the converter
+    import main
+    first_page = []
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            converter, options = main.load_converter()
+            converter.run_img2pdf(
+                source_dir, output_file, lambda progress: first_page or first_page.append(time.time() - started),
+                **{**options, "cache_dir": None, "incremental": False, "checkpoint": False}
+            )
+        finally:
+            sys.stdout = stdout
+    return {"seconds": first_page[0], "total_seconds": time.time() - started}
+
+
+def summarize(samples):
+    seconds = [s["seconds"] for s in samples if s["seconds"] is not None]
+    if not seconds:
+        return {"seconds": None, **{k: v for k, v in samples[0].items() if k != "seconds"}}
+    return {"median": round(statistics.median(seconds), 4), "min": round(min(seconds), 4), "runs": len(seconds)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="fresh processes per measurement")
+    parser.add_argument("--output", help="additionally write the JSON result to this file")
+    parser.add_argument("--measure", nargs=4, metavar=("NAME", "STARTED", "SOURCE", "OUTPUT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        name, started, source_dir, output_file = args.measure
+        print(json.dumps(measure(name, float(started), source_dir, output_file)))
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_dir = os.path.join(tmp_dir, "source")
+        create_tree(source_dir, 2, 4, (1600, 1200))
+        output_file = os.path.join(tmp_dir, "output.pdf")
+
+        for name in MEASUREMENTS:
+            samples = [
+                run_isolated(__file__, "--measure", name, repr(time.time()), source_dir, output_file)
+                for _ in range(args.repeat)
+            ]
+            results[name] = summarize(samples)
+
+    result = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
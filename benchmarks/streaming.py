@@ -0,0 +1,73 @@
+"""
+Peak memory of the in-memory canvas compared with the streaming writer on a synthetic tree.
+
+Every mode runs in its own process, so the peak RSS of one mode does not leak into the other.
+
+    python benchmarks/streaming.py --categories 100 --images 100
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import peak_rss_kb, run_isolated
+from benchmarks.synthetic import create_tree
+
+
+MODES = {"canvas": None, "streaming": 1}
+
+
+def run_mode(mode, source_dir, output_file):
+    from core.img2pdf import IMG2PDF
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            IMG2PDF.run_img2pdf(source_dir, output_file, lambda x: x, stream_pages=MODES[mode])
+        finally:
+            sys.stdout = stdout
+    seconds = time.perf_counter() - start
+
+    return {
+        "mode": mode,
+        "seconds": round(seconds, 3),
+        "peak_rss_kb": peak_rss_kb(),
+        "output_bytes": os.path.getsize(output_file),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--categories", type=int, default=100)
+    parser.add_argument("--images", type=int, default=100, help="images per category")
+    parser.add_argument("--size", default="320x240")
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--source", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        print(json.dumps(run_mode(args.mode, args.source, args.output)))
+        return
+
+    size = tuple(int(i) for i in args.size.split("x"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_dir = os.path.join(tmp_dir, "source")
+        image_count = create_tree(source_dir, args.categories, args.images, size)
+        results = [
+            run_isolated(__file__, "--mode", mode, "--source", source_dir, "--output", os.path.join(tmp_dir, mode + ".pdf"))
+            for mode in MODES
+        ]
+
+    for result in results:
+        result["images"] = image_count
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark suite of the whole pipeline on deterministic synthetic source trees.
+
+Every scenario varies the image count, resolution, format and category count. Every scenario runs in
+its own process and reports wall time, images/sec, peak RSS, peak temp-disk bytes and output size.
+The JSON result also records the commit, so results of different commits can be compared.
+
+    python benchmarks/suite.py
+    python benchmarks/suite.py --scenario png --scenario alpha-png --repeat 3 --output results.json
+    python benchmarks/suite.py --options '{"workers": 1, "stream_pages": 1}'
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import DirSizeSampler, peak_rss_kb, run_isolated
+from benchmarks.synthetic import create_tree
+
+
+# Scenario name: arguments of create_tree
+SCENARIOS = {
+    "jpeg": {"categories": 4, "images": 25, "size": (1600, 1200), "formats": ("jpg",)},
+    "png": {"categories": 4, "images": 25, "size": (1600, 1200), "formats": ("png",)},
+    "alpha-png": {"categories": 4, "images": 25, "size": (1600, 1200), "formats": ("png-alpha",)},
+    "mixed": {"categories": 4, "images": 25, "size": (1600, 1200), "formats": ("jpg", "png", "png-alpha")},
+    "high-resolution": {"categories": 2, "images": 8, "size": (6000, 4000), "formats": ("jpg",)},
+    "many-images": {"categories": 2, "images": 500, "size": (320, 240), "formats": ("jpg",)},
+    "many-categories": {"categories": 100, "images": 3, "size": (640, 480), "formats": ("jpg", "png")},
+}
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scenario(source_dir, output_file, tmp_dir, options):
+    # Temp files of this process and of its workers end up in tmp_dir, where they are measured
+    os.environ["TMPDIR"] = tmp_dir
+    tempfile.tempdir = tmp_dir
+
+    from core.img2pdf import IMG2PDF
+
+    sampler = DirSizeSampler(tmp_dir)
+    sampler.start()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            img2pdf = IMG2PDF.run_img2pdf(source_dir, output_file, lambda x: x, **options)
+        finally:
+            sys.stdout = stdout
+            temp_bytes = sampler.stop()
+    seconds = time.perf_counter() - start
+
+    return {
+        "seconds": round(seconds, 3),
+        "images_per_sec": round(img2pdf.image_count / seconds, 2) if seconds > 0 else None,
+        "peak_rss_kb": peak_rss_kb(),
+        "peak_worker_rss_kb": peak_rss_kb(children=True),
+        "peak_temp_bytes": temp_bytes,
+        "output_bytes": os.path.getsize(output_file),
+        "pages": img2pdf.builder.page_count,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="scenario to run, may be repeated (default: all)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario, the source tree is generated once")
+    parser.add_argument("--options", default="{}", help="JSON object of IMG2PDF options used for every run")
+    parser.add_argument("--output", help="additionally write the JSON result to this file")
+    parser.add_argument("--run", nargs=4, metavar=("SOURCE", "OUTPUT", "TMP", "OPTIONS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        source_dir, output_file, tmp_dir, options = args.run
+        print(json.dumps(run_scenario(source_dir, output_file, tmp_dir, json.loads(options))))
+        return
+
+    results = []
+    for name in args.scenario or SCENARIOS:
+        tree = SCENARIOS[name]
+        with tempfile.TemporaryDirectory() as root_dir:
+            source_dir = os.path.join(root_dir, "source")
+            image_count = create_tree(source_dir, **tree)
+
+            for i in range(args.repeat):
+                tmp_dir = os.path.join(root_dir, f"tmp{i}")
+                os.makedirs(tmp_dir)
+                output_file = os.path.join(root_dir, f"output{i}.pdf")
+                result = run_isolated(__file__, "--run", source_dir, output_file, tmp_dir, args.options)
+                results.append({
+                    "scenario": name,
+                    "run": i,
+                    "categories": tree["categories"],
+                    "images": image_count,
+                    "size": "x".join(str(i) for i in tree["size"]),
+                    "formats": list(tree["formats"]),
+                    **result,
+                })
+                print(f"{name} #{i}: {result['seconds']} s, {result['images_per_sec']} Bilder/s", file=sys.stderr)
+
+    report = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "options": json.loads(args.options),
+        "results": results,
+    }
+    report_json = json.dumps(report, indent=2)
+    print(report_json)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report_json + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Deterministic synthetic source trees for the benchmarks.
+
+The same arguments always produce the same files, so runs on different commits are comparable.
+"""
+import os
+import random
+
+from PIL import Image, ImageDraw
+
+
+def create_image(rnd, size, mode="RGB"):
+    # Gradient background with a few shapes, compresses roughly like a real photo or scan
+    img = Image.linear_gradient("L").resize(size).convert(mode)
+    draw = ImageDraw.Draw(img)
+    for _ in range(8):
+        x0, y0 = rnd.randrange(size[0]), rnd.randrange(size[1])
+        x1, y1 = x0 + rnd.randrange(size[0] // 2 + 1), y0 + rnd.randrange(size[1] // 2 + 1)
+        color = tuple(rnd.randrange(256) for _ in mode)
+        draw.rectangle((x0, y0, x1, y1), fill=color)
+    return img
+
+
+# Synthetic format name: file extension and image mode
+FORMATS = {
+    "jpg": ("jpg", "RGB"),
+    "png": ("png", "RGB"),
+    "png-alpha": ("png", "RGBA"),
+}
+
+
+def create_tree(root, categories=10, images=100, size=(320, 240), formats=("jpg",), seed=0):
+    """Creates categories sub-folders with images files in each, cycling through formats (keys of FORMATS)."""
+    rnd = random.Random(seed)
+    count = 0
+    for c in range(categories):
+        category_dir = os.path.join(root, f"Kapitel {c + 1}")
+        os.makedirs(category_dir, exist_ok=True)
+
+        for i in range(images):
+            ext, mode = FORMATS[formats[count % len(formats)]]
+            count += 1
+            create_image(rnd, size, mode).save(os.path.join(category_dir, f"Bild {i + 1}.{ext}"))
+
+    return count
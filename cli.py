@@ -0,0 +1,192 @@
+"""
+Headless image folder to PDF conversion.
+
+    python cli.py SOURCE_DIR OUTPUT.pdf [SOURCE_DIR OUTPUT.pdf ...]
+    python cli.py --manifest jobs.json --jobs 4
+
+One JSON summary per job is printed to stdout (images, pages, bytes, seconds).
+With --trace, every job also writes OUTPUT.trace.json (Chrome trace events, open in chrome://tracing
+or Perfetto) and its summary contains the time and bytes per stage. With --profile, every job writes
+a cProfile dump OUTPUT.prof of the main process (python -m pstats OUTPUT.prof).
+The layout options apply to all chapters; in a manifest, "chapter_layouts" overrides them per chapter name.
+With --checkpoint, completed chapters are kept next to the output until it is complete. Ctrl+C cancels
+after the current image; rerunning the job, or --resume OUTPUT.pdf, continues where it stopped.
+With --watch, a single job keeps running and rebuilds the changed chapters a few seconds (--debounce)
+after files were added, changed or removed, until Ctrl+C.
+With --max-pages, --max-mb or --split-chapters, every job is split into volumes OUTPUT_Band1.pdf, ... at chapter
+boundaries, rendered --jobs at a time. OUTPUT.pdf becomes the master index linking to the chapters of all volumes.
+With --preview, images are drafted down to a low resolution and quality, e.g. from their EXIF thumbnails,
+so order and layout can be checked page for page in a fraction of the time.
+Exit codes: 0 all jobs succeeded, 1 at least one job failed, 2 invalid arguments.
+"""
+import argparse
+import json
+import multiprocessing
+import sys
+
+from core.batch import Job, load_checkpoint_job, load_job_manifest, run_jobs
+from core.jobControl import JobController
+from core.layoutPlan import GRIDS, ORIENTATIONS, PAGE_SIZES
+from core.volumes import VolumeSplit, run_volumes
+from core.watchFolder import FolderWatch
+
+
+EXIT_OK = 0
+EXIT_JOB_FAILED = 1
+EXIT_USAGE = 2
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pairs", nargs="*", metavar="SOURCE_DIR OUTPUT", help="pairs of source directory and output file")
+    parser.add_argument("--manifest", help="JSON list of jobs with input_dir, output_file and optional options")
+    parser.add_argument("--jobs", type=int, default=1, help="number of jobs converted at the same time")
+    parser.add_argument("--workers", type=int, help="image workers per job (default: 1 with --jobs > 1, else all cores)")
+    parser.add_argument("--dpi", type=int, help="target image resolution")
+    parser.add_argument("--cache-dir", help="persistent cache of prepared images")
+    parser.add_argument("--cache-mb", type=int, help="size cap of the cache in MiB, least recently used images are evicted (default: 2048)")
+    parser.add_argument("--stream-pages", type=int, help="flush the output every N pages to cap memory")
+    parser.add_argument("--per-page", type=int, choices=GRIDS, help="images per page (default: 2)")
+    parser.add_argument("--page-size", choices=PAGE_SIZES, help="page size of the chapters (default: letter)")
+    parser.add_argument("--orientation", choices=ORIENTATIONS, help="page orientation, auto follows the images of each chapter")
+    parser.add_argument("--fit-grid", action="store_true", help="arrange the grid per chapter to show the images the largest")
+    parser.add_argument("--optimize", action="store_true", help="embed photos of lossless sources as JPEG, report the bytes saved")
+    parser.add_argument("--optimize-quality", type=int, help="JPEG quality of --optimize (default: 80)")
+    parser.add_argument("--preview", action="store_true", help="quick draft of the same pages at low image resolution and quality")
+    parser.add_argument("--memory-mb", type=int, help="memory budget for decoding images in MiB, shared by all workers")
+    parser.add_argument("--prefetch", type=int, help="source files read ahead in background threads, for network shares")
+    parser.add_argument("--prefetch-mb", type=int, help="memory budget of the read-ahead in MiB (default: 256)")
+    parser.add_argument("--parallel-categories", action="store_true", help="render every chapter in its own process")
+    parser.add_argument("--incremental", action="store_true", help="only render chapters changed since the last run")
+    parser.add_argument("--scan-index", action="store_true", help="keep an index OUTPUT.scan.json per job, rescan only changed files")
+    parser.add_argument("--checkpoint", action="store_true", help="keep completed chapters next to the output, a rerun continues there")
+    parser.add_argument("--resume", action="append", default=[], metavar="OUTPUT", help="continue the interrupted job of this output file")
+    parser.add_argument("--watch", action="store_true", help="keep running, rebuild the changed chapters when files are added")
+    parser.add_argument("--debounce", type=float, default=2.0, help="seconds without changes before --watch rebuilds (default: 2)")
+    parser.add_argument("--max-pages", type=int, help="split every job into volumes of at most N pages")
+    parser.add_argument("--max-mb", type=float, help="split every job into volumes of about N MB, estimated from the resolution the images get on their pages")
+    parser.add_argument("--split-chapters", action="store_true", help="split every job into one volume per chapter")
+    parser.add_argument("--trace", action="store_true", help="record per-stage timings, write OUTPUT.trace.json per job")
+    parser.add_argument("--profile", action="store_true", help="write a cProfile dump OUTPUT.prof per job")
+    parser.add_argument("--summary", help="additionally write the JSON summaries to this file")
+    parser.add_argument("--verbose", action="store_true", help="print the conversion log to stderr")
+    return parser, parser.parse_args(argv)
+
+
+def get_layout(args):
+    layout = {
+        "images_per_page": args.per_page,
+        "page_size": args.page_size,
+        "orientation": args.orientation,
+        "fit_grid": args.fit_grid or None,
+    }
+    return {k: v for k, v in layout.items() if v is not None} or None
+
+
+def get_options(args):
+    options = {
+        "workers": args.workers if args.workers is not None else (1 if args.jobs > 1 else None),
+        "target_dpi": args.dpi,
+        "cache_dir": args.cache_dir,
+        "cache_max_bytes": args.cache_mb * 1024 ** 2 if args.cache_mb is not None else None,
+        "stream_pages": args.stream_pages,
+        "prefetch": args.prefetch,
+        "prefetch_bytes": args.prefetch_mb * 1024 ** 2 if args.prefetch_mb is not None else None,
+        "parallel_categories": args.parallel_categories or None,
+        "incremental": args.incremental or None,
+        "layout": get_layout(args),
+        "optimize": args.optimize or None,
+        "optimize_quality": args.optimize_quality,
+        "memory_budget": args.memory_mb * 1024 ** 2 if args.memory_mb is not None else None,
+        "checkpoint": args.checkpoint or None,
+        "preview": args.preview or None,
+    }
+    return {k: v for k, v in options.items() if v is not None}
+
+
+def main(argv=None):
+    parser, args = parse_args(argv)
+
+    if len(args.pairs) % 2 != 0:
+        parser.print_usage(sys.stderr)
+        print("Quellverzeichnis und Ausgabedatei müssen paarweise angegeben werden", file=sys.stderr)
+        return EXIT_USAGE
+
+    options = get_options(args)
+    jobs = [Job(args.pairs[i], args.pairs[i + 1], dict(options)) for i in range(0, len(args.pairs), 2)]
+    if args.manifest is not None:
+        try:
+            manifest_jobs = load_job_manifest(args.manifest)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ungültige Job-Datei '{args.manifest}': {e}", file=sys.stderr)
+            return EXIT_USAGE
+        # Options of the command line are defaults, the manifest can override them per job
+        for job in manifest_jobs:
+            job.options = {**options, **job.options}
+        jobs.extend(manifest_jobs)
+    for output_file in args.resume:
+        try:
+            jobs.append(load_checkpoint_job(output_file))
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return EXIT_USAGE
+
+    if not jobs:
+        parser.print_usage(sys.stderr)
+        return EXIT_USAGE
+
+    for job in jobs:
+        if args.scan_index:
+            job.options.setdefault("scan_index_file", job.output_file + ".scan.json")
+        if args.trace:
+            job.options.setdefault("trace_file", job.output_file + ".trace.json")
+        if args.profile:
+            job.options.setdefault("profile_file", job.output_file + ".prof")
+
+    split = VolumeSplit(
+        args.max_pages, int(args.max_mb * 1024 ** 2) if args.max_mb is not None else None, args.split_chapters
+    )
+    if split.enabled and args.watch:
+        print("--watch kann nicht in Bände aufteilen", file=sys.stderr)
+        return EXIT_USAGE
+
+    if args.watch:
+        if len(jobs) != 1:
+            print("--watch überwacht genau einen Quellordner", file=sys.stderr)
+            return EXIT_USAGE
+        controller = JobController()
+        with controller.handle_signals():
+            summaries = FolderWatch(jobs[0], debounce=args.debounce, controller=controller, verbose=args.verbose).run()
+            return write_summaries(summaries, args.summary)
+
+    if split.enabled:
+        return write_summaries(
+            (summary for job in jobs for summary in run_volumes(job, split, args.jobs, args.verbose)), args.summary
+        )
+
+    return write_summaries(run_jobs(jobs, args.jobs, args.verbose), args.summary)
+
+
+def write_summaries(summaries, summary_path=None):
+    exit_code = EXIT_OK
+    summary_file = open(summary_path, "w", encoding="utf-8") if summary_path else None
+    try:
+        for summary in summaries:
+            line = json.dumps(summary, ensure_ascii=False)
+            print(line, flush=True)
+            if summary_file is not None:
+                summary_file.write(line + "\n")
+                summary_file.flush()
+            if summary["status"] != "ok":
+                exit_code = EXIT_JOB_FAILED
+    finally:
+        if summary_file is not None:
+            summary_file.close()
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    # Required for the worker pools in the frozen executable
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,120 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import inspect
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from core.img2pdf import IMG2PDF
+from core.jobControl import JobCancelled, JobController, load_checkpoint
+
+
+# Options a job may set: the parameters of IMG2PDF, except the ones given by the job itself
+JOB_OPTIONS = frozenset(inspect.signature(IMG2PDF).parameters) - {"input_dir", "output_file", "controller"}
+
+# Cancellation shared by the jobs of a pool, set in every job process by init_job_worker
+_cancel_event = None
+
+
+class Job:
+    def __init__(self, input_dir, output_file, options=None):
+        self.input_dir = input_dir
+        self.output_file = output_file
+        self.options = options or {}
+
+    def validate(self):
+        if not os.path.isdir(self.input_dir):
+            return f"Der gewählte Quellpfad ist ungültig: '{self.input_dir}'"
+        output_dir = os.path.dirname(os.path.abspath(self.output_file))
+        if not os.path.isdir(output_dir):
+            return f"Der gewählte Zielpfad ist ungültig: '{output_dir}'"
+        if not isinstance(self.options, dict):
+            return "Die Optionen müssen ein Objekt sein"
+        unknown = sorted(set(self.options) - JOB_OPTIONS)
+        if unknown:
+            return f"Unbekannte Optionen: {', '.join(unknown)}"
+        return None
+
+    @staticmethod
+    def from_dict(job):
+        return Job(job["input_dir"], job["output_file"], job.get("options"))
+
+    def __str__(self):
+        return f"{self.input_dir} -> {self.output_file}"
+
+
+def load_job_manifest(path):
+    """A job manifest is a JSON list of objects with input_dir, output_file and optional IMG2PDF options."""
+    with open(path, encoding="utf-8") as f:
+        return [Job.from_dict(job) for job in json.load(f)]
+
+
+def load_checkpoint_job(output_file):
+    """The job of an interrupted conversion, from the checkpoint next to its output file."""
+    checkpoint = load_checkpoint(output_file + ".checkpoint")
+    if checkpoint is None or checkpoint["job"]["options"] is None:
+        raise ValueError(f"Kein Zwischenstand für '{output_file}' gefunden")
+    return Job(checkpoint["job"]["input_dir"], output_file, {**checkpoint["job"]["options"], "checkpoint": True})
+
+
+def init_job_worker(cancel_event):
+    global _cancel_event
+    _cancel_event = cancel_event
+
+
+def run_job(job, verbose=False, controller=None, update_progress_callback=None):
+    # Runs inside a worker process, the log goes to stderr, stdout is kept for the summaries
+    summary = {"input_dir": job.input_dir, "output_file": job.output_file}
+
+    error = job.validate()
+    if error is not None:
+        return {**summary, "status": "error", "error": error}
+
+    start = time.perf_counter()
+    controller = controller or JobController(_cancel_event)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stderr if verbose else devnull), \
+            controller.handle_signals():
+        try:
+            img2pdf = IMG2PDF.run_img2pdf(
+                job.input_dir, job.output_file, update_progress_callback or (lambda progress: None), controller, **job.options
+            )
+        except JobCancelled:
+            return {**summary, "status": "cancelled", "seconds": round(time.perf_counter() - start, 3)}
+        except Exception as e:
+            return {**summary, "status": "error", "error": f"{type(e).__name__}: {e}", "seconds": round(time.perf_counter() - start, 3)}
+
+    summary = {
+        **summary,
+        "status": "ok",
+        "images": img2pdf.image_count,
+        "pages": img2pdf.builder.page_count,
+        "bytes": os.path.getsize(job.output_file),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+    if img2pdf.checkpoint is not None:
+        summary["resumed_chapters"] = img2pdf.checkpoint.resumed
+    if img2pdf.skipped:
+        summary["skipped"] = [{"path": path, "reason": reason} for path, reason in img2pdf.skipped]
+    if img2pdf.optimize:
+        summary["savings"] = img2pdf.get_savings()
+    if img2pdf.tracer.enabled:
+        summary["stages"] = img2pdf.tracer.get_stage_totals()
+    return summary
+
+
+def run_jobs(jobs, concurrency=1, verbose=False):
+    """Runs the jobs on a shared process pool, yields one summary per job in order of completion."""
+    if concurrency <= 1:
+        for job in jobs:
+            yield run_job(job, verbose)
+        return
+
+    # A signal cancels all jobs, the running ones stop after their current image and the others right away
+    cancel_event = multiprocessing.Event()
+    with JobController(cancel_event).handle_signals(), ProcessPoolExecutor(
+            max_workers=concurrency, initializer=init_job_worker, initargs=(cancel_event,)) as executor:
+        futures = [executor.submit(run_job, job, verbose) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
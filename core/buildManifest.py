@@ -0,0 +1,71 @@
+import json
+import os
+
+
+# Bump when the page layout changes, so pages of an older output are never reused
+MANIFEST_VERSION = 1
+
+
+def get_file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class BuildManifest:
+    """
+    Records for every category of an output the source files and the page range it produced.
+
+    The manifest is stored next to the output file. On the next run, categories with unchanged files
+    can be copied from the previous output instead of being rendered again.
+    """
+
+    def __init__(self, output_file, options):
+        self.output_file = output_file
+        self.manifest_file = output_file + ".manifest.json"
+        self.options = {"version": MANIFEST_VERSION, **options}
+        self.previous = self._load()
+        self.categories = []
+
+    def _load(self):
+        try:
+            with open(self.manifest_file, encoding="utf-8") as f:
+                manifest = json.load(f)
+            output_stamp = get_file_stamp(self.output_file)
+        except (OSError, ValueError):
+            return {}
+
+        # The output must be exactly the one the manifest was written for
+        if manifest.get("options") != self.options or manifest.get("output") != output_stamp:
+            return {}
+
+        return {entry["name"]: entry for entry in manifest["categories"]}
+
+    @staticmethod
+    def get_category_files(category):
+        return [[image.full_name, image.info.size, image.info.mtime] for image in category.images]
+
+    def get_reusable(self, category):
+        entry = self.previous.get(category.name)
+        if entry is not None and entry["files"] == self.get_category_files(category):
+            return entry
+        return None
+
+    def add_category(self, category, first_page):
+        self.categories.append({
+            "name": category.name,
+            "files": self.get_category_files(category),
+            "first_page": first_page,
+            "page_count": category.get_page_count(),
+        })
+
+    def save(self):
+        manifest = {
+            "options": self.options,
+            "output": get_file_stamp(self.output_file),
+            "categories": self.categories,
+        }
+
+        tmp_file = self.manifest_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_file, self.manifest_file)
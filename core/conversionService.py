@@ -0,0 +1,441 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import uuid
+
+from core.batch import Job, run_job
+from core.jobControl import JobController
+from core.pdfBuilder import preload_fonts
+
+
+# Jobs finished within this many seconds make up the throughput
+THROUGHPUT_WINDOW = 60.0
+# Progress is reported in steps of this many percent, so a large job does not flood its event stream
+PROGRESS_STEP = 1.0
+# Finished jobs kept for queries, the oldest are forgotten first
+MAX_FINISHED_JOBS = 1000
+# Host headers accepted besides the address the server listens on, others come from e.g. DNS rebinding
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+# Seconds an event stream waits for new events before checking the connection again
+EVENT_WAIT = 15.0
+
+FINAL_STATUSES = ("ok", "error", "cancelled")
+
+# Events of the running jobs to the service, set in every worker by init_service_worker
+_events = None
+
+
+def init_service_worker(events):
+    global _events
+    _events = events
+    # Ctrl+C reaches the whole process group, the service stops its workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Font metrics are parsed once per worker, before its first job
+    preload_fonts()
+
+
+def warm_up_worker():
+    return os.getpid()
+
+
+def run_service_job(job_id, job, cancel_event, verbose=False):
+    # Runs inside a pooled worker, progress is sent to the service as events
+    last_progress = [None]
+
+    def report_progress(progress):
+        if last_progress[0] is None or progress - last_progress[0] >= PROGRESS_STEP or (progress >= 100 > last_progress[0]):
+            last_progress[0] = progress
+            _events.put((job_id, {"type": "progress", "progress": round(progress, 1)}))
+
+    _events.put((job_id, {"type": "started", "worker": os.getpid()}))
+    return run_job(job, verbose, JobController(cancel_event), report_progress)
+
+
+class ServiceJob:
+    """A job of the service with the events it reported so far."""
+
+    def __init__(self, job_id, job, priority):
+        self.id = job_id
+        self.job = job
+        self.priority = priority
+        self.status = "queued"
+        self.progress = 0.0
+        self.summary = None
+        self.events = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = None  # Shared with the worker while running
+
+    @property
+    def done(self):
+        return self.status in FINAL_STATUSES
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "input_dir": self.job.input_dir,
+            "output_file": self.job.output_file,
+            "priority": self.priority,
+            "status": self.status,
+            "progress": self.progress,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "summary": self.summary,
+        }
+
+
+class ConversionService:
+    """
+    Converts jobs on a pool of worker processes that stay warm between jobs.
+
+    The workers are started, with ReportLab and Pillow imported, before the first job arrives. Jobs wait in a
+    priority queue, higher priorities first and in order of arrival within one priority, and are handed to the
+    pool only once a worker is free, so a new urgent job waits for the running ones at most. Every job keeps
+    its events (queued, started, progress, finished), which can be followed while it runs.
+    """
+
+    def __init__(self, workers=2, job_options=None, verbose=False):
+        self.workers = workers
+        # The pool runs the jobs side by side, the images of a job are prepared by its own worker
+        self.job_options = {"workers": 1, **(job_options or {})}
+        self.verbose = verbose
+
+        self.jobs = {}
+        self._queue = []  # (-priority, arrival, job id), cancelled jobs are skipped when popped
+        self._arrival = itertools.count()
+        self._condition = threading.Condition()
+        self._free_workers = workers
+        self._recent = deque()  # (finish time, images, pages, seconds queued) of the throughput window
+        self._totals = Counter()
+        self._start_time = time.monotonic()
+        self._closed = False
+
+        # Cancellation of running jobs, a plain multiprocessing event can only be passed to workers at their start
+        self._manager = multiprocessing.Manager()
+        self._events = multiprocessing.Queue()
+        self._executor = self._start_pool()
+        threading.Thread(target=self._receive_events, daemon=True).start()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+
+    def _start_pool(self):
+        executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_service_worker, initargs=(self._events,))
+        # Workers are started on demand, so the first jobs would still start them cold
+        for _ in range(self.workers):
+            executor.submit(warm_up_worker)
+        return executor
+
+    def _add_event(self, service_job, event):
+        # Called with the condition held
+        service_job.events.append({"time": time.time(), **event})
+        self._condition.notify_all()
+
+    def submit(self, job, priority=0):
+        """Queues the job and returns its ServiceJob. Raises ValueError if the job is invalid, RuntimeError once closed."""
+        error = job.validate()
+        if error is not None:
+            raise ValueError(error)
+        job.options = {**self.job_options, **job.options}
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Der Dienst wird beendet")
+            service_job = ServiceJob(uuid.uuid4().hex, job, priority)
+            self.jobs[service_job.id] = service_job
+            heapq.heappush(self._queue, (-priority, next(self._arrival), service_job.id))
+            self._add_event(service_job, {"type": "queued", "queue_depth": self._get_queue_depth()})
+        return service_job
+
+    def cancel(self, job_id):
+        """Cancels a queued job right away, a running one after its current image. Raises KeyError if unknown."""
+        with self._condition:
+            service_job = self.jobs[job_id]
+            if service_job.status == "queued":
+                self._finish(service_job, {
+                    "input_dir": service_job.job.input_dir, "output_file": service_job.job.output_file, "status": "cancelled"
+                })
+            elif service_job.status == "running":
+                service_job.cancel_event.set()
+            return service_job
+
+    def get_job(self, job_id):
+        with self._condition:
+            return self.jobs[job_id]
+
+    def list_jobs(self):
+        with self._condition:
+            return list(self.jobs.values())
+
+    def get_events(self, service_job, start=0, timeout=None):
+        """The events of the job from index start on and whether it is done, waits up to timeout seconds for new ones."""
+        with self._condition:
+            self._condition.wait_for(lambda: len(service_job.events) > start or service_job.done or self._closed, timeout)
+            return service_job.events[start:], service_job.done or self._closed
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or (self._queue and self._free_workers > 0))
+                if self._closed:
+                    return
+                _, _, job_id = heapq.heappop(self._queue)
+                service_job = self.jobs.get(job_id)
+                if service_job is None or service_job.status != "queued":
+                    continue  # Cancelled while queued
+
+                self._free_workers -= 1
+                service_job.cancel_event = self._manager.Event()
+                service_job.status = "running"
+                service_job.started = time.time()
+                executor = self._executor
+
+            try:
+                future = executor.submit(run_service_job, job_id, service_job.job, service_job.cancel_event, self.verbose)
+            except (BrokenProcessPool, RuntimeError) as e:
+                future = Future()
+                future.set_exception(e)
+            future.add_done_callback(lambda f, service_job=service_job, executor=executor: self._complete(service_job, executor, f))
+
+    def _complete(self, service_job, executor, future):
+        summary = {"input_dir": service_job.job.input_dir, "output_file": service_job.job.output_file}
+        try:
+            summary = future.result()
+        except BrokenProcessPool as e:
+            # A worker died, e.g. stopped by the OS for its memory, the pool is started again for the next jobs
+            summary = {**summary, "status": "error", "error": f"Worker beendet: {e}"}
+            self._restart_pool(executor)
+        except Exception as e:
+            summary = {**summary, "status": "error", "error": f"{type(e).__name__}: {e}"}
+
+        with self._condition:
+            self._free_workers += 1
+            self._finish(service_job, summary)
+
+    def _finish(self, service_job, summary):
+        # Called with the condition held
+        service_job.status = summary["status"]
+        service_job.summary = summary
+        service_job.finished = time.time()
+        service_job.cancel_event = None
+        if service_job.status == "ok":
+            service_job.progress = 100.0
+
+        self._totals[service_job.status] += 1
+        if service_job.started is not None:
+            self._recent.append((
+                time.monotonic(), summary.get("images", 0), summary.get("pages", 0), service_job.started - service_job.created
+            ))
+        self._add_event(service_job, {"type": "finished", "status": service_job.status, "summary": summary})
+        self._forget_finished()
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, service_job in self.jobs.items() if service_job.done]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def _restart_pool(self, executor):
+        with self._condition:
+            if self._executor is not executor or self._closed:
+                return  # Already restarted for another job of the broken pool
+            self._executor = self._start_pool()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _receive_events(self):
+        while True:
+            item = self._events.get()
+            if item is None:
+                return
+            job_id, event = item
+            with self._condition:
+                service_job = self.jobs.get(job_id)
+                # Events may arrive after the result, e.g. the last progress
+                if service_job is None or service_job.done:
+                    continue
+                if event["type"] == "progress":
+                    service_job.progress = event["progress"]
+                self._add_event(service_job, event)
+
+    def _get_queue_depth(self):
+        return sum(1 for service_job in self.jobs.values() if service_job.status == "queued")
+
+    def get_metrics(self):
+        with self._condition:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0][0] > THROUGHPUT_WINDOW:
+                self._recent.popleft()
+            window = max(min(THROUGHPUT_WINDOW, now - self._start_time), 1e-3)
+            statuses = Counter(service_job.status for service_job in self.jobs.values())
+
+            return {
+                "workers": self.workers,
+                "busy_workers": self.workers - self._free_workers,
+                "queue_depth": statuses["queued"],
+                "running": statuses["running"],
+                "finished": {status: self._totals[status] for status in FINAL_STATUSES},
+                "uptime_seconds": round(now - self._start_time, 1),
+                "throughput": {
+                    "window_seconds": round(window, 1),
+                    "jobs_per_minute": round(len(self._recent) / window * 60, 2),
+                    "images_per_second": round(sum(r[1] for r in self._recent) / window, 2),
+                    "pages_per_second": round(sum(r[2] for r in self._recent) / window, 2),
+                    "mean_queue_seconds": round(sum(r[3] for r in self._recent) / len(self._recent), 3) if self._recent else None,
+                },
+            }
+
+    def close(self):
+        """Cancels the queued and running jobs and stops the workers."""
+        with self._condition:
+            self._closed = True
+            for service_job in self.jobs.values():
+                if service_job.status == "running":
+                    service_job.cancel_event.set()
+            self._condition.notify_all()
+
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._events.put(None)
+        self._manager.shutdown()
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """JSON API of the service, see service.py."""
+
+    server_version = "img2pdf-service"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status, message):
+        self._send_json(status, {"error": message})
+
+    def _check_request(self, json_body=False):
+        """
+        Rejects requests that a web page in a local browser could send. Such a page can only post simple content
+        types without a preflight, and reaches the service by a foreign host name only.
+        """
+        host = urlparse(f"//{self.headers.get('Host', '')}").hostname
+        if host not in LOCAL_HOSTS and host != self.server.server_address[0]:
+            self._send_error(403, f"Unbekannter Host '{self.headers.get('Host', '')}'")
+            return False
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if json_body and content_type != "application/json":
+            self._send_error(415, "Content-Type muss application/json sein")
+            return False
+        return True
+
+    def _get_route(self):
+        return [part for part in urlparse(self.path).path.split("/") if part]
+
+    def _get_job(self, job_id):
+        try:
+            return self.service.get_job(job_id)
+        except KeyError:
+            self._send_error(404, f"Unbekannter Auftrag '{job_id}'")
+            return None
+
+    def do_GET(self):
+        if not self._check_request():
+            return
+        route = self._get_route()
+        if route == ["metrics"]:
+            self._send_json(200, self.service.get_metrics())
+        elif route == ["jobs"]:
+            self._send_json(200, [service_job.to_dict() for service_job in self.service.list_jobs()])
+        elif len(route) == 2 and route[0] == "jobs":
+            service_job = self._get_job(route[1])
+            if service_job is not None:
+                self._send_json(200, service_job.to_dict())
+        elif len(route) == 3 and route[0] == "jobs" and route[2] == "events":
+            service_job = self._get_job(route[1])
+            if service_job is not None:
+                self._stream_events(service_job)
+        else:
+            self._send_error(404, f"Unbekannter Pfad '{self.path}'")
+
+    def do_POST(self):
+        if not self._check_request(json_body=True):
+            return
+        if self._get_route() != ["jobs"]:
+            self._send_error(404, f"Unbekannter Pfad '{self.path}'")
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = Job.from_dict(body)
+            priority = int(body.get("priority", 0))
+            service_job = self.service.submit(job, priority)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            message = f"Fehlendes Feld {e}" if isinstance(e, KeyError) else str(e)
+            self._send_error(400, f"Ungültiger Auftrag: {message}")
+            return
+        except RuntimeError as e:
+            self._send_error(503, str(e))
+            return
+        self._send_json(202, service_job.to_dict())
+
+    def do_DELETE(self):
+        if not self._check_request():
+            return
+        route = self._get_route()
+        if len(route) != 2 or route[0] != "jobs":
+            self._send_error(404, f"Unbekannter Pfad '{self.path}'")
+            return
+
+        try:
+            service_job = self.service.cancel(route[1])
+        except KeyError:
+            self._send_error(404, f"Unbekannter Auftrag '{route[1]}'")
+            return
+        self._send_json(200, service_job.to_dict())
+
+    def _stream_events(self, service_job):
+        # One JSON line per event, the response ends with the finished event
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        sent = 0
+        try:
+            while True:
+                events, done = self.service.get_events(service_job, sent, EVENT_WAIT)
+                for event in events:
+                    self.wfile.write(json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n")
+                self.wfile.flush()
+                sent += len(events)
+                if done:
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client stopped following
+
+
+class ConversionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        super().__init__(address, ServiceRequestHandler)
+        self.service = service
+        self.verbose = verbose
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import pickle
+import sys
+
+from core.imagePrep import ImageStream
+
+
+# Bump when the prepared stream format changes, so stale entries are never reused
+CACHE_VERSION = 3
+CACHE_EXT = ".stream"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def get_default_cache_dir():
+    if sys.platform == "win32":
+        base_dir = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base_dir = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base_dir, "img2pdf")
+
+
+class ImageCache:
+    """
+    Content-addressed on-disk cache of prepared image streams with LRU eviction.
+
+    The cache directory may be shared by several processes at once (category workers, the window and the
+    command line), each one evicting on its own, so an entry can disappear at any time. That is a miss, never an error.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def get_key(path, render_params):
+        stat = os.stat(path)
+        key = repr((CACHE_VERSION, os.path.abspath(path), stat.st_mtime_ns, stat.st_size, render_params))
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_EXT)
+
+    def _entries(self):
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(CACHE_EXT):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue  # Evicted by another process
+                    yield entry.path, stat.st_mtime, stat.st_size
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                fields = pickle.load(f)
+            # Touch the entry, eviction drops the least recently used ones first
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return ImageStream(*fields)
+
+    def put(self, key, image_stream):
+        path = self._path(key)
+        fields = (
+            image_stream.width, image_stream.height, image_stream.color_space, image_stream.filters, image_stream.data,
+            image_stream.saved_bytes,
+        )
+
+        # Unique per process, category workers may write the same entry at the same time
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(fields, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.replace(tmp_path, path)
+
+        self.total_bytes += size
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # Shrink to 90% of the cap, so not every following put triggers another scan
+        target_bytes = self.max_bytes * 0.9
+        entries = sorted(self._entries(), key=lambda e: e[1])
+
+        self.total_bytes = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if self.total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Evicted by another process
+            self.total_bytes -= size
+
+    def __str__(self):
+        return f"Bild-Cache: {self.hits} Treffer, {self.misses} neu berechnet"
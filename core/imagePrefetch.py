@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+from core.instrumentation import NULL_TRACER
+
+
+def read_file(path, tracer=NULL_TRACER):
+    with tracer.span("fetch", image=path) as span, open(path, "rb") as f:
+        data = f.read()
+        span["bytes"] = len(data)
+    return data
+
+
+class Prefetcher:
+    """
+    Reads the raw bytes of the upcoming images in background threads.
+
+    On network shares every read pays the full latency, reading a window of files concurrently hides it
+    behind the decoding and drawing of the current images. Only the settings are stored here, so a
+    prefetcher can be handed to a category worker process.
+    """
+
+    def __init__(self, window=16, max_bytes=256 * 1024 ** 2, threads=None):
+        self.window = max(1, window)
+        # Soft limit: no new read starts while the finished, unconsumed buffers exceed it
+        self.max_bytes = max_bytes
+        self.threads = threads if threads is not None else min(self.window, 8)
+
+    @staticmethod
+    def _held_bytes(pending):
+        return sum(len(future.result()) for _, future in pending if future is not None and future.done())
+
+    def read_ahead(self, items, get_path, tracer=NULL_TRACER):
+        """
+        Yields (item, data) in the order of items, data being the content of get_path(item).
+        Items for which get_path returns None are passed through with data None.
+        """
+        items = iter(items)
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="prefetch")
+        try:
+            exhausted = False
+            while True:
+                # Top up the window, at least one read is always allowed, even if a single file exceeds the budget
+                while not exhausted and len(pending) < self.window and (
+                        not pending or self._held_bytes(pending) < self.max_bytes):
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    path = get_path(item)
+                    pending.append((item, executor.submit(read_file, path, tracer) if path is not None else None))
+
+                if not pending:
+                    return
+
+                item, future = pending.popleft()
+                yield item, future.result() if future is not None else None
+        finally:
+            executor.shutdown(cancel_futures=True)
@@ -0,0 +1,383 @@
+from concurrent.futures import ProcessPoolExecutor, Future
+from collections import deque
+import contextlib
+import hashlib
+import io
+import os
+import signal
+import sys
+import zlib
+
+from PIL import ExifTags, Image, ImageOps
+
+from core.imageScan import get_orientation
+from core.instrumentation import NULL_TRACER, Tracer
+from core.memoryBudget import ImageMemoryError
+
+
+JPEG_QUALITY = 75
+# Images with more distinct colors are treated as photos, fewer colors are diagrams or screenshots
+PHOTO_MIN_COLORS = 1024
+# ... unless a grayscale photo: enough colors and no flat background covering this share of the image
+PHOTO_MIN_GRAYS = 128
+PHOTO_MAX_FLAT_SHARE = 0.1
+PASSTHROUGH_MODES = ("L", "RGB")
+COLOR_SPACES = {"L": "DeviceGray", "RGB": "DeviceRGB"}
+# Pillow stores every other mode with 4 bytes per pixel
+BYTES_PER_PIXEL = {"1": 1, "L": 1, "P": 1, "I;16": 2}
+JPEG_DRAFT_SCALES = (1, 2, 4, 8)
+
+# Preview mode: low resolution and quality, EXIF thumbnails are used down to this share of the target size
+PREVIEW_DPI = 36
+PREVIEW_QUALITY = 30
+PREVIEW_MIN_THUMBNAIL_SCALE = 0.5
+EXIF_THUMBNAIL_OFFSET = 0x0201
+EXIF_THUMBNAIL_LENGTH = 0x0202
+# Thumbnails have no EXIF data of their own, they are stored in the orientation of the image
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Images that can not be prepared within the memory budget are skipped instead of failing the run
+SKIPPED_ERRORS = (ImageMemoryError, MemoryError, Image.DecompressionBombError)
+
+DEFAULT_MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS
+_memory_budget = None
+
+
+class ImageStream:
+    """Ready-to-embed image XObject stream, either DCT (JPEG) or Flate (raw pixels) encoded."""
+    __slots__ = ("width", "height", "color_space", "filters", "data", "digest", "saved_bytes")
+
+    def __init__(self, width, height, color_space, filters, data, saved_bytes=0):
+        self.width = width
+        self.height = height
+        self.color_space = color_space
+        self.filters = filters
+        self.data = data
+        self.digest = hashlib.md5(data).hexdigest()
+        # Bytes saved against the lossless stream, if a lossless source was recompressed as JPEG
+        self.saved_bytes = saved_bytes
+
+    @staticmethod
+    def from_jpeg(size, mode, data):
+        return ImageStream(*size, COLOR_SPACES[mode], ("DCTDecode",), data)
+
+    @staticmethod
+    def from_pixels(img):
+        return ImageStream(*img.size, COLOR_SPACES[img.mode], ("FlateDecode",), zlib.compress(img.tobytes()))
+
+
+def use_memory_budget(memory_budget):
+    """
+    Sets the MemoryBudget of this process, also used as initializer of worker pools.
+    A budget replaces the decompression bomb limit of Pillow, huge images are drafted down or skipped instead.
+    """
+    global _memory_budget
+    _memory_budget = memory_budget
+    Image.MAX_IMAGE_PIXELS = DEFAULT_MAX_IMAGE_PIXELS if memory_budget is None else None
+
+
+def init_worker(memory_budget):
+    # Ctrl+C reaches the whole process group, cancelling is left to the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    use_memory_budget(memory_budget)
+
+
+def get_decode_bytes(size, mode, orientation=1):
+    """Estimated peak memory of decoding and downsampling, the full size copies dominate."""
+    decoded = size[0] * size[1] * BYTES_PER_PIXEL.get(mode, 4)
+    copies = 1 + (mode not in PASSTHROUGH_MODES) + (orientation != 1)
+    return decoded * copies
+
+
+def fit_draft_size(img, draft_size, orientation, max_bytes):
+    # JPEGs decode at 1/1, 1/2, 1/4 or 1/8 of their size, below the target size if only that fits the budget
+    width, height = img.size
+    natural_scale = max(s for s in JPEG_DRAFT_SCALES if s == 1 or (width / s >= draft_size[0] and height / s >= draft_size[1]))
+    for scale in JPEG_DRAFT_SCALES:
+        if scale < natural_scale:
+            continue
+        scaled_size = (-(-width // scale), -(-height // scale))
+        if get_decode_bytes(scaled_size, img.mode, orientation) <= max_bytes:
+            return draft_size if scale == natural_scale else (width // scale, height // scale)
+    return width // JPEG_DRAFT_SCALES[-1], height // JPEG_DRAFT_SCALES[-1]
+
+
+def get_exif_thumbnail(img, min_size):
+    """The thumbnail a camera embeds into the EXIF data of a JPEG, decoded, or None if there is none of min_size."""
+    exif_data = img.info.get("exif")
+    if img.format != "JPEG" or not exif_data:
+        return None
+
+    thumbnail_ifd = img.getexif().get_ifd(ExifTags.IFD.IFD1)
+    offset, length = thumbnail_ifd.get(EXIF_THUMBNAIL_OFFSET), thumbnail_ifd.get(EXIF_THUMBNAIL_LENGTH)
+    if offset is None or length is None:
+        return None
+
+    # Offsets count from the TIFF header, which follows the "Exif\0\0" marker
+    data = exif_data[6 + offset:6 + offset + length]
+    try:
+        thumbnail = Image.open(io.BytesIO(data))
+        if thumbnail.width < min_size[0] or thumbnail.height < min_size[1]:
+            return None
+        thumbnail.load()
+    except (OSError, SyntaxError):
+        return None  # E.g. cut off by an editor
+    return thumbnail
+
+
+def get_save_format(ext):
+    return Image.registered_extensions()["." + ext.lower()]
+
+
+def get_target_size(width, height, target_dpi):
+    # Placement box in points (1/72 inch) to pixels at the target resolution
+    return max(1, round(width / 72 * target_dpi)), max(1, round(height / 72 * target_dpi))
+
+
+def can_passthrough(img, orientation, target_size):
+    # The original JPEG can be embedded as is, if it needs no downscale and no rotation
+    return (
+        img.format == "JPEG"
+        and img.mode in PASSTHROUGH_MODES
+        and orientation == 1
+        and img.width <= target_size[0]
+        and img.height <= target_size[1]
+    )
+
+
+def has_alpha(img):
+    return img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+
+
+def to_embed_mode(img):
+    if img.mode in PASSTHROUGH_MODES:
+        return img
+    if not has_alpha(img):
+        return img.convert("RGB")
+
+    # Transparent areas show the white page, converting alone would expose the hidden color values
+    img = img.convert("RGBA")
+    background = Image.new("RGB", img.size, "white")
+    background.paste(img, mask=img.getchannel("A"))
+    return background
+
+
+def is_photographic(img):
+    if img.mode in ("1", "P"):
+        return False
+
+    # getcolors gives up as soon as there are more colors than the limit
+    colors = img.getcolors(PHOTO_MIN_COLORS)
+    if colors is None:
+        return True
+    return len(colors) >= PHOTO_MIN_GRAYS and max(colors)[0] < img.width * img.height * PHOTO_MAX_FLAT_SHARE
+
+
+def downsample(img, target_size, resample=Image.LANCZOS):
+    if img.width <= target_size[0] and img.height <= target_size[1]:
+        return img  # Never upscale
+
+    img = to_embed_mode(img)
+
+    # Cheap integer box reduction first, the final filter only works on the remaining factor
+    factor = min(img.width // target_size[0], img.height // target_size[1])
+    if factor >= 2:
+        img = img.reduce(factor)
+
+    return img.resize(target_size, resample)
+
+
+def encode_jpeg(img, quality):
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return ImageStream.from_jpeg(img.size, img.mode, buffer.getvalue())
+
+
+def encode_image(img, save_format, recompress_quality=None):
+    """
+    Lossless sources stay lossless, unless recompress_quality is given, they are photos then encoded as JPEG,
+    if that is smaller than the lossless stream.
+    """
+    img = to_embed_mode(img)
+
+    if save_format == "JPEG":
+        return encode_jpeg(img, JPEG_QUALITY)
+
+    image_stream = ImageStream.from_pixels(img)
+    if recompress_quality is not None:
+        # Smooth or downsampled photos often compress better without loss
+        jpeg_stream = encode_jpeg(img, recompress_quality)
+        if len(jpeg_stream.data) < len(image_stream.data):
+            jpeg_stream.saved_bytes = len(image_stream.data) - len(jpeg_stream.data)
+            return jpeg_stream
+    return image_stream
+
+
+def prepare_image(path, ext, target_size, recompress_quality=None, preview=False, tracer=NULL_TRACER, data=None):
+    """
+    Runs inside a worker process: decode, resize and encode one image, from data if it was prefetched.
+    A preview uses the EXIF thumbnail if it is large enough, fast filters and a low JPEG quality.
+    """
+    memory_budget = _memory_budget
+    with Image.open(io.BytesIO(data) if data is not None else path) as img:
+        orientation = get_orientation(img)
+        if can_passthrough(img, orientation, target_size):
+            if data is None:
+                with tracer.span("read", image=path) as span, open(path, "rb") as f:
+                    data = f.read()
+                    span["bytes"] = len(data)
+            return ImageStream.from_jpeg(img.size, img.mode, data)
+
+        # JPEGs are scaled down in the DCT domain while decoding, the target size is given in display orientation
+        draft_size = target_size[::-1] if orientation in (5, 6, 7, 8) else target_size
+        # Broken EXIF data may hold other orientations, such images are decoded like outside the preview
+        if preview and (orientation == 1 or orientation in ORIENTATION_TRANSPOSE):
+            with tracer.span("thumbnail", image=path) as span:
+                thumbnail = get_exif_thumbnail(img, [round(s * PREVIEW_MIN_THUMBNAIL_SCALE) for s in draft_size])
+                span["hit"] = thumbnail is not None
+            if thumbnail is not None:
+                img = thumbnail.transpose(ORIENTATION_TRANSPOSE[orientation]) if orientation != 1 else thumbnail
+                orientation = 1
+        if memory_budget is not None and img.format == "JPEG":
+            draft_size = fit_draft_size(img, draft_size, orientation, memory_budget.max_bytes)
+        img.draft(img.mode, draft_size)
+
+        # Full resolution decodes wait for each other, until their memory is free
+        decode_bytes = get_decode_bytes(img.size, img.mode, orientation)
+        with memory_budget.reserve(decode_bytes) if memory_budget is not None else contextlib.nullcontext():
+            with tracer.span("decode", image=path) as span:
+                img.load()
+                span["pixels"] = img.width * img.height
+
+            # Decided on the source, resizing adds blended colors to the edges of diagrams
+            save_format = get_save_format(ext)
+            if recompress_quality is not None and (save_format == "JPEG" or not is_photographic(img)):
+                recompress_quality = None
+
+            with tracer.span("resize", image=path):
+                if orientation != 1:
+                    img = ImageOps.exif_transpose(img)
+                image_resized = downsample(img, target_size, Image.BILINEAR if preview else Image.LANCZOS)
+
+    with tracer.span("encode", image=path) as span:
+        if preview:
+            image_stream = encode_jpeg(to_embed_mode(image_resized), PREVIEW_QUALITY)
+        else:
+            image_stream = encode_image(image_resized, save_format, recompress_quality)
+        span["bytes"] = len(image_stream.data)
+    return image_stream
+
+
+def prepare_image_traced(path, ext, target_size, recompress_quality=None, preview=False, data=None):
+    # Worker side of a traced run, the events are merged into the tracer of the main process
+    tracer = Tracer()
+    return prepare_image(path, ext, target_size, recompress_quality, preview, tracer, data), tracer.events
+
+
+class ImagePreparer:
+    def __init__(self, workers=None, lookahead=None, cache=None, tracer=NULL_TRACER, prefetcher=None):
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        # Bounded look-ahead, so only a few prepared images are held in memory at once
+        self.lookahead = lookahead if lookahead is not None else self.workers * 2
+        self.cache = cache
+        self.tracer = tracer
+        self.prefetcher = prefetcher
+        # Lossless sources embedded as JPEG by digest, with the bytes saved compared with their lossless streams.
+        # Identical images are embedded once, so their saving counts once.
+        self.recompressed = {}
+        self.skipped = []  # Path and reason of images skipped
+
+    def _lookup(self, job):
+        # A task is the job, its cache key if it has to be prepared, and the cached stream on a hit
+        if self.cache is None:
+            return job, None, None
+
+        path, *render_params = job
+        with self.tracer.span("cache", image=path) as span:
+            key = self.cache.get_key(path, (*render_params, JPEG_QUALITY))
+            image_stream = self.cache.get(key)
+            span["hit"] = image_stream is not None
+        if image_stream is not None:
+            return job, None, image_stream
+        return job, key, None
+
+    def _submit(self, executor, task, data):
+        job, key, image_stream = task
+        future = Future()
+        if image_stream is not None:
+            future.set_result(image_stream)
+            return future, None, job
+
+        if executor is not None:
+            if self.tracer.enabled:
+                return executor.submit(prepare_image_traced, *job, data=data), key, job
+            return executor.submit(prepare_image, *job, data=data), key, job
+
+        try:
+            future.set_result(prepare_image(*job, tracer=self.tracer, data=data))
+        except Exception as e:
+            future.set_exception(e)
+        return future, key, job
+
+    def _result(self, future, key, job):
+        try:
+            image_stream = future.result()
+        except SKIPPED_ERRORS as e:
+            reason = str(e) or type(e).__name__
+            self.skipped.append((job[0], reason))
+            print(f"Warnung: Bild '{job[0]}' übersprungen: {reason}", file=sys.stderr)
+            return None
+
+        if isinstance(image_stream, tuple):
+            image_stream, events = image_stream
+            self.tracer.extend(events)
+        if key is not None:
+            self.cache.put(key, image_stream)
+
+        if image_stream.saved_bytes:
+            self.recompressed[image_stream.digest] = image_stream.saved_bytes
+        return image_stream
+
+    def _keep_finished(self, pending):
+        # Images prepared ahead of an interrupted run are cached for the next one
+        if self.cache is None:
+            return
+        for future, key, _ in pending:
+            if key is not None and future.done() and not future.cancelled() and future.exception() is None:
+                image_stream = future.result()
+                self.cache.put(key, image_stream[0] if isinstance(image_stream, tuple) else image_stream)
+
+    def prepare(self, jobs):
+        """Yields the prepared image streams in the same order as jobs, a job being the prepare_image arguments."""
+        tasks = (self._lookup(job) for job in jobs)
+        if self.prefetcher is not None:
+            # Cached images are not read at all
+            tasks = self.prefetcher.read_ahead(tasks, lambda task: task[0][0] if task[2] is None else None, self.tracer)
+        else:
+            tasks = ((task, None) for task in tasks)
+
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=init_worker, initargs=(_memory_budget,)
+        ) if self.workers > 1 else None
+        pending = deque()
+        try:
+            for task, data in tasks:
+                if len(pending) >= self.lookahead:
+                    yield self._result(*pending.popleft())
+                pending.append(self._submit(executor, task, data))
+
+            while pending:
+                yield self._result(*pending.popleft())
+        finally:
+            tasks.close()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            self._keep_finished(pending)
@@ -0,0 +1,149 @@
+import json
+import os
+import re
+
+from PIL import Image
+
+
+EXIF_ORIENTATION = 0x0112
+# Bump when the records of the index change, older index files are ignored
+SCAN_INDEX_VERSION = 2
+
+_DIGITS = re.compile(r"(\d+)")
+
+
+def natural_key(name):
+    """Sort key ordering numbers by value, e.g. "Bild 2" before "Bild 10". The name breaks ties, so the order is total."""
+    parts = _DIGITS.split(name.casefold())
+    parts[1::2] = map(int, parts[1::2])
+    return parts, name
+
+
+class ImageInfo:
+    """Compact metadata record of a source image. No pixel data or file handle is kept."""
+    __slots__ = ("path", "width", "height", "format", "orientation", "size", "mtime")
+
+    def __init__(self, path, width, height, format, orientation, size, mtime):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.format = format
+        self.orientation = orientation
+        self.size = size
+        self.mtime = mtime
+
+    @property
+    def display_size(self):
+        # EXIF orientations 5 to 8 are rotated by 90 degrees
+        if self.orientation in (5, 6, 7, 8):
+            return self.height, self.width
+        return self.width, self.height
+
+    def __repr__(self):
+        return f"ImageInfo({self.path!r}, {self.width}x{self.height}, {self.format})"
+
+
+def get_orientation(img):
+    # Pillow decodes a whole PNG to look for EXIF data after the pixels, like browsers only the one before is used
+    if img.format == "PNG" and "exif" not in img.info:
+        return 1
+    return img.getexif().get(EXIF_ORIENTATION, 1)
+
+
+def scan_image(entry):
+    # Image.open only parses the header, the handle is closed again right away
+    with Image.open(entry.path) as img:
+        width, height = img.size
+        img_format = img.format
+        orientation = get_orientation(img)
+
+    stat = entry.stat()
+    return ImageInfo(entry.path, width, height, img_format, orientation, stat.st_size, stat.st_mtime)
+
+
+def list_images(path, extensions):
+    with os.scandir(path) as entries:
+        images = [entry for entry in entries if entry.is_file() and entry.name.endswith(extensions)]
+    images.sort(key=lambda entry: natural_key(entry.name))
+    return images
+
+
+def scan_directory(path, extensions):
+    return [scan_image(entry) for entry in list_images(path, extensions)]
+
+
+def list_directories(path):
+    with os.scandir(path) as entries:
+        directories = [entry for entry in entries if entry.is_dir()]
+    directories.sort(key=lambda entry: natural_key(entry.name))
+    return directories
+
+
+class ScanIndex:
+    """
+    Persisted metadata of scanned images, so a rescan only reads the headers of the files that changed.
+
+    Every directory is listed again, and each file is compared by its own size and modification time: a file
+    overwritten in place keeps the time of its directory. On Windows, the listing already contains both, so
+    unchanged files are not opened or stat'ed at all.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.directories = self._load()
+        self.rescanned = 0
+        self.reused = 0
+
+    def _load(self):
+        try:
+            with open(self.index_file, encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return index["directories"] if index.get("version") == SCAN_INDEX_VERSION else {}
+
+    def scan_directory(self, path, extensions):
+        key = os.path.abspath(path)
+        entry = self.directories.get(key)
+        # Records are name, width, height, format, orientation, size and modification time in ns
+        indexed = {}
+        if entry is not None and entry["extensions"] == list(extensions):
+            indexed = {record[0]: record for record in entry["images"]}
+
+        images, records = [], []
+        for file in list_images(path, extensions):
+            stat = file.stat()
+            record = indexed.get(file.name)
+            if record is not None and record[5:] == [stat.st_size, stat.st_mtime_ns]:
+                self.reused += 1
+                info = ImageInfo(file.path, *record[1:6], stat.st_mtime)
+            else:
+                self.rescanned += 1
+                info = scan_image(file)
+                record = [file.name, info.width, info.height, info.format, info.orientation, stat.st_size, stat.st_mtime_ns]
+            images.append(info)
+            records.append(record)
+
+        self.directories[key] = {"extensions": list(extensions), "images": records}
+        return images
+
+    def forget(self, path):
+        """Drops the records of a directory, its images are read again on the next scan."""
+        self.directories.pop(os.path.abspath(path), None)
+
+    def clear(self):
+        self.directories = {}
+
+    def prune(self, root, scanned):
+        """Drops the indexed directories below root, that were not scanned anymore."""
+        root = os.path.join(os.path.abspath(root), "")
+        scanned = {os.path.abspath(path) for path in scanned}
+        self.directories = {
+            path: entry for path, entry in self.directories.items() if not path.startswith(root) or path in scanned
+        }
+
+    def save(self):
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"version": SCAN_INDEX_VERSION, "directories": self.directories}, f)
+        os.replace(tmp_file, self.index_file)
@@ -1,51 +1,70 @@
 from reportlab.pdfgen import canvas
+from concurrent.futures import ProcessPoolExecutor, wait
+import contextlib
+import mmap
 import os
+import sys
 import tempfile
 
 from core.pdfBuilder import PDFBuilder, FontCollection, PDFImage, IMG_FORMAT_EXT
+from core.imagePrep import PREVIEW_DPI, ImagePreparer, get_target_size, init_worker, use_memory_budget
+from core.imageScan import ScanIndex, list_directories, scan_directory
+from core.imageCache import DEFAULT_MAX_BYTES, ImageCache
+from core.imagePrefetch import Prefetcher
+from core.buildManifest import BuildManifest
+from core.pdfStream import PDFPartReader
+from core.instrumentation import NULL_TRACER, Tracer, profile
+from core.layoutPlan import LayoutOptions, LayoutPlan, WIDTH, HEIGHT
+from core.memoryBudget import MemoryBudget
+from core.jobControl import Checkpoint, JobController
+
+
+# TODO:
+# - Koordinaten System startet nicht oben links
 
+DEFAULT_TARGET_DPI = 150
 
-# TODO: Bild Reihenfolg numerisch
-# - Koordinaten System startet nicht oben links
 
 class IMGCategory:
     def __init__(self, name, path, images):
         self.name = name
         self.path = path
         self.images = images
-        self.partition_size = 2
-
-    def get_partitions(self):
-        return [self.images[i:i+self.partition_size] for i in range(0, len(self.images), self.partition_size)]
+        self.layout = None  # ChapterLayout, set by the layout plan before rendering
 
     def get_page_count(self):
-        return ((len(self.images) - 1) // self.partition_size) + 1
+        return self.layout.page_count
 
-    def add_to_pdf(self, image_count_finished, image_count_total, update_progress_callback):
-        def __inner(c: canvas.Canvas, builder: PDFBuilder):
-            page_width, page_height = builder.width_page, builder.height_page
+    def get_image_sizes(self):
+        return [image.info.display_size for image in self.images]
 
+    @staticmethod
+    def get_header_height(font=FontCollection.DEFAULT_H1, margin=25):
+        return font.size + margin * 2
+
+    def add_to_pdf(self, prepared_images, image_count_finished, image_count_total, update_progress_callback):
+        def __inner(c: canvas.Canvas, builder: PDFBuilder):
             img_c_total = image_count_total
             img_c_finished = image_count_finished
 
+            builder.set_page_size(self.layout.page_size)
+
             # add bookmark
-            c.bookmarkPage(self.name)
+            builder.bookmark_page(self.name)
 
-            for images_for_page in self.get_partitions():
+            for images_for_page in self.layout.get_pages():
 
                 # Add category header
-                height_images = builder.add_page(
+                builder.add_page(
                     builder.use_font(FontCollection.DEFAULT_H1)(
-                        self.add_category(self.name, page_height)
+                        self.add_category(self.name, builder.height_page)
                     ), new_page=False
                 )
 
                 # Add images
-                max_width, max_height = page_width, height_images // self.partition_size  # TODO: leave space for category
-
-                for image_count, image in enumerate(images_for_page):
-
-                    self.add_image(image, max_width, max_height, image_count)(c, builder)
+                for i in images_for_page:
+                    # The canvas is swapped on page breaks in streaming mode, so always draw on the current one
+                    self.add_image(self.images[i], next(prepared_images), self.layout.get_placement(i))(builder.canvas, builder)
 
                     # Update image progress
                     img_c_finished += 1
@@ -54,29 +73,25 @@ class IMGCategory:
                     print(f"Fortschritt: {img_c_finished}/{img_c_total} ({progress:.2f}%)")#, end="\r", flush=True)
 
                 builder.next_page()
-                #return img_c_finished # TODO: REMOVE
             return img_c_finished
         return __inner
 
-    def add_image(self, image, max_width, max_height, image_count):
+    def add_image(self, image, image_stream, placement):
         def __inner(c: canvas.Canvas, builder: PDFBuilder):
-            x_img, y_img, width_img, height_img = image.get_format(
-                max_width,
-                max_height,
-                y_offset=(self.partition_size - image_count - 1) * max_height
-            )
-            with tempfile.NamedTemporaryFile(delete=False, suffix="." + image.ext, mode="w+b") as temp_file:
-                image_resized = image.img.resize((1000, round(1000 * width_img / height_img)))
-                image_resized.save(temp_file.name)  # , format=image.ext.upper())
-                c.drawImage(temp_file.name, x_img, y_img, width=width_img, height=height_img)
-
-            builder.draw_string_width_centered(y_img - 20, image.name)
+            _, x_img, y_img, width_img, height_img, x_cell, width_cell = placement
+            if image_stream is None:
+                # Skipped image, the page plan stays the same
+                builder.draw_placeholder(x_img, y_img, width_img, height_img, "Bild übersprungen")
+            else:
+                # Embed the prepared stream straight from memory
+                builder.draw_image_stream(image_stream, x_img, y_img, width_img, height_img)
+
+            builder.draw_string_centered(x_cell, width_cell, y_img - 20, image.name)
         return __inner
 
     def add_category(self, category, page_height):
         def __inner(c: canvas.Canvas, builder: PDFBuilder):
-            margin = 25
-            header_height = builder.current_font.size + margin * 2
+            header_height = self.get_header_height(builder.current_font)
             height_images = page_height - header_height
             builder.draw_string_width_centered(
                 height_images + PDFBuilder.get_el_centered(header_height, builder.current_font.size),
@@ -88,66 +103,469 @@ class IMGCategory:
     def __str__(self):
         return self.name
 
+
+def get_prepare_jobs(image_categories, target_dpi, recompress_quality=None, preview=False):
+    # Images are decoded at exactly the pixel size of their placement box
+    for category in image_categories:
+        for i, image in enumerate(category.images):
+            placement = category.layout.get_placement(i)
+            target_size = get_target_size(placement[WIDTH], placement[HEIGHT], target_dpi)
+            yield image.path, image.ext, target_size, recompress_quality, preview
+
+
+def scan_categories(input_dir, scan=scan_directory, chapters=None):
+    """Chapters and images in natural order, e.g. "Bild 2" before "Bild 10". chapters limits the chapters by name."""
+    category_objects = list()
+    for category in list_directories(input_dir):
+        if chapters is not None and category.name not in chapters:
+            continue
+        category_objects.append(IMGCategory(
+            name=category.name,
+            path=category.path,
+            images=[PDFImage(info) for info in scan(category.path, IMG_FORMAT_EXT)]
+        ))
+    return category_objects
+
+
+def render_category_part(category, part_file, target_dpi, cache_dir, prefetcher=None, recompress_quality=None, trace=False,
+                         preview=False, cache_max_bytes=DEFAULT_MAX_BYTES):
+    # Runs inside a worker process: renders one category into its own PDF part
+    tracer = Tracer() if trace else NULL_TRACER
+    cache = ImageCache(cache_dir, cache_max_bytes) if cache_dir is not None else None
+    builder = PDFBuilder(part_file, stream_pages=1, tracer=tracer)
+    builder.apply_default_font()
+
+    preparer = ImagePreparer(1, cache=cache, tracer=tracer, prefetcher=prefetcher)
+    prepared_images = preparer.prepare(get_prepare_jobs([category], target_dpi, recompress_quality, preview))
+
+    # Progress and warnings are reported by the main process
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull), \
+            tracer.span("category", category=category.name, images=len(category.images)):
+        builder.add_page(
+            category.add_to_pdf(prepared_images, 0, len(category.images), lambda progress: None), new_page=False
+        )
+    builder.save()
+
+    return {
+        "bookmarks": builder.writer.destinations,
+        "page_count": builder.writer.page_count,
+        "cache": (cache.hits, cache.misses) if cache is not None else (0, 0),
+        "events": list(tracer.events),
+        "savings": builder.get_shared_images(),
+        "recompressed": preparer.recompressed,
+        "skipped": preparer.skipped,
+    }
+
+
 class IMG2PDF:
-    def __init__(self, input_dir, output_file):
+    def __init__(self, input_dir, output_file, workers=None, target_dpi=DEFAULT_TARGET_DPI, cache_dir=None, stream_pages=None,
+                 parallel_categories=False, incremental=False, trace_file=None, profile_file=None,
+                 prefetch=None, prefetch_bytes=256 * 1024 ** 2, layout=None, chapter_layouts=None,
+                 optimize=False, optimize_quality=80, memory_budget=None,
+                 scan_index_file=None, controller=None, checkpoint=False, chapters=None, preview=False,
+                 cache_max_bytes=DEFAULT_MAX_BYTES):
         self.input_dir = input_dir
         self.output_file = output_file
-        self.builder = PDFBuilder(self.output_file)
+        self.workers = workers
+        # Preview mode: the same pages, cover and index, with images drafted down for a quick check of order and layout
+        self.preview = preview
+        self.target_dpi = min(target_dpi, PREVIEW_DPI) if preview else target_dpi
+        # Prepared images are kept in the cache directory up to cache_max_bytes, the least recently used are evicted first
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.cache = ImageCache(cache_dir, cache_max_bytes) if cache_dir is not None else None
+        self.image_count = 0
+        # Names of the chapters to convert, e.g. of one volume, all chapters if None
+        self.chapters = set(chapters) if chapters is not None else None
+
+        # Metadata of unchanged directories is taken from the index of the last run instead of being scanned again
+        self.scan_index = ScanIndex(scan_index_file) if scan_index_file is not None else None
+
+        # Reads the next prefetch source files ahead in background threads, hides the latency of network shares
+        self.prefetcher = Prefetcher(prefetch, prefetch_bytes) if prefetch else None
+
+        # Stage timings are only recorded with a trace file, otherwise the tracer calls are no-ops
+        self.trace_file = trace_file
+        self.profile_file = profile_file
+        self.tracer = Tracer() if trace_file is not None else NULL_TRACER
+
+        # Optimization mode: photos from lossless sources are embedded as JPEG of this quality
+        self.optimize = optimize
+        self.recompress_quality = optimize_quality if optimize and not preview else None
+        self.savings = [0, 0]  # Shared images and bytes of category workers
+        self.recompressed = {}  # Bytes saved by digest, the same image recompressed by several workers counts once
+
+        # Decode memory in bytes shared by all workers, huge images are drafted down or skipped to stay below
+        self.memory_budget = MemoryBudget(memory_budget) if memory_budget else None
+        self.skipped = []
+
+        # Layout options as dicts, the default for all chapters and the ones of single chapters by name
+        self.layout_plan = LayoutPlan(
+            LayoutOptions.from_dict(layout),
+            {name: LayoutOptions.from_dict(options) for name, options in (chapter_layouts or {}).items()}
+        )
+
+        # Options that change the rendered pages, pages of an earlier run are only reused if they match
+        render_options = {
+            "target_dpi": self.target_dpi, "layout": self.layout_plan.to_dict(),
+            "recompress_quality": self.recompress_quality, "memory_budget": memory_budget, "preview": preview,
+        }
+
+        # Incremental builds copy unchanged categories from the previous output, so the new one is written next to it first
+        self.manifest = BuildManifest(output_file, render_options) if incremental else None
+
+        # Cancelling stops after the current image, completed chapters are kept in the checkpoint for the next run
+        self.controller = controller or JobController()
+        self.checkpoint = Checkpoint(output_file, input_dir, render_options) if checkpoint else None
+        if self.checkpoint is not None and self.cache is None:
+            # Prepared streams of an interrupted chapter are reused as well
+            self.cache_dir = self.checkpoint.cache_dir
+            self.cache = ImageCache(self.cache_dir, cache_max_bytes)
+
+        # An unfinished output never replaces the previous one
+        self.builder_file = output_file + ".tmp" if incremental or checkpoint else output_file
+
+        # Category parts are merged by the streaming writer
+        self.parallel_categories = parallel_categories
+        if (parallel_categories or incremental or checkpoint) and not stream_pages:
+            stream_pages = 1
+        self.builder = PDFBuilder(self.builder_file, stream_pages=stream_pages, tracer=self.tracer)
+
+    def plan_layout(self, image_categories):
+        # Cover and index page come first
+        first_page = self.builder.current_page + 2
+        with self.tracer.span("layout"):
+            self.layout_plan.plan(
+                [(c.name, c.get_image_sizes()) for c in image_categories], first_page, IMGCategory.get_header_height()
+            )
+        for category in image_categories:
+            category.layout = self.layout_plan.chapters[category.name]
 
     def get_categories(self):
-        category_objects = list()
-
-        categories = os.listdir(self.input_dir)
-        for category in categories:
-            category_path = os.path.join(self.input_dir, category)
-            if os.path.isdir(category_path):
-                category_objects.append(IMGCategory(
-                    name=category,
-                    path=category_path,
-                    images=[PDFImage(os.path.join(category_path, img)) for img in os.listdir(category_path) if img.endswith(IMG_FORMAT_EXT)]
-                ))
+        with self.tracer.span("scan") as span:
+            scan = self.scan_index.scan_directory if self.scan_index is not None else scan_directory
+            category_objects = scan_categories(self.input_dir, scan, self.chapters)
+            span["images"] = sum(len(c.images) for c in category_objects)
+
+            if self.scan_index is not None:
+                # Only a complete scan tells which folders are gone
+                if self.chapters is None:
+                    self.scan_index.prune(self.input_dir, [c.path for c in category_objects])
+                self.scan_index.save()
+                span["rescanned"] = self.scan_index.rescanned
 
         return category_objects
 
+    @contextlib.contextmanager
+    def open_previous_output(self):
+        if self.manifest is None or not self.manifest.previous:
+            yield None
+            return
+
+        with open(self.output_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield PDFPartReader(data)
+
+    def get_reusable_categories(self, image_categories, previous_output):
+        if previous_output is None:
+            return {}
+
+        reusable = dict()
+        for category in image_categories:
+            entry = self.manifest.get_reusable(category)
+            if entry is not None:
+                reusable[category.name] = entry
+        return reusable
+
+    def reuse_category(self, category, entry, previous_output):
+        first_page, page_count = entry["first_page"], entry["page_count"]
+        self.builder.append_part(
+            previous_output, {category.name: 0}, page_count, page_range=(first_page, first_page + page_count)
+        )
+
+    def get_resumable_categories(self, image_categories, reusable):
+        if self.checkpoint is None:
+            return {}
+
+        resumable = dict()
+        for category in image_categories:
+            entry = self.checkpoint.get_resumable(category) if category.name not in reusable else None
+            if entry is not None:
+                resumable[category.name] = entry
+        return resumable
+
+    def append_part_file(self, part_file, bookmarks, page_count):
+        with open(part_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as part_data:
+            self.builder.append_part(part_data, bookmarks, page_count)
+
+    def resume_category(self, category, entry):
+        self.append_part_file(self.checkpoint.get_part_file(category), entry["bookmarks"], entry["page_count"])
+        self.checkpoint.resumed += 1
+
+    def render_checkpoint_part(self, category, prepared_images, image_count_finished, image_count_total, update_progress_callback):
+        # The chapter is rendered to its own part first, so it survives an interruption of the run
+        part_file = self.checkpoint.get_part_file(category)
+        builder = PDFBuilder(part_file, stream_pages=1, tracer=self.tracer)
+        builder.apply_default_font()
+        try:
+            image_count_finished = builder.add_page(
+                category.add_to_pdf(prepared_images, image_count_finished, image_count_total, update_progress_callback), new_page=False
+            )
+        except BaseException:
+            builder.discard()
+            raise
+        builder.save()
+
+        shared_images, shared_image_bytes = builder.get_shared_images()
+        self.savings[0] += shared_images
+        self.savings[1] += shared_image_bytes
+        self.checkpoint.add_chapter(category, builder.writer.destinations, builder.writer.page_count)
+        self.append_part_file(part_file, builder.writer.destinations, builder.writer.page_count)
+        return image_count_finished
+
+    def record_category(self, category, first_page):
+        if self.manifest is not None:
+            self.manifest.add_category(category, first_page)
+
+    @staticmethod
+    def report_category(category, message, image_count_finished, image_count_total, update_progress_callback):
+        progress = (image_count_finished / image_count_total * 100) if image_count_total else 100
+        update_progress_callback(progress)
+        print(f"Kapitel '{category}' {message}: {image_count_finished}/{image_count_total} ({progress:.2f}%)")
+
+    def add_categories(self, image_categories, update_progress_callback):
+        image_count_total = sum(len(c.images) for c in image_categories)
+        image_count_finished = 0
+
+        with self.open_previous_output() as previous_output:
+            reusable = self.get_reusable_categories(image_categories, previous_output)
+            resumable = self.get_resumable_categories(image_categories, reusable)
+
+            # Images are decoded, resized and encoded ahead of the canvas by a worker pool
+            preparer = ImagePreparer(self.workers, cache=self.cache, tracer=self.tracer, prefetcher=self.prefetcher)
+            prepared_images = preparer.prepare(get_prepare_jobs(
+                [c for c in image_categories if c.name not in reusable and c.name not in resumable],
+                self.target_dpi, self.recompress_quality, self.preview
+            ))
+
+            for category in image_categories:
+                first_page = self.builder.current_page - 1
+
+                if category.name in reusable:
+                    self.reuse_category(category, reusable[category.name], previous_output)
+                    image_count_finished += len(category.images)
+                    self.report_category(category, "unverändert übernommen", image_count_finished, image_count_total, update_progress_callback)
+                elif category.name in resumable:
+                    self.resume_category(category, resumable[category.name])
+                    image_count_finished += len(category.images)
+                    self.report_category(category, "aus Zwischenstand übernommen", image_count_finished, image_count_total, update_progress_callback)
+                elif self.checkpoint is not None:
+                    with self.tracer.span("category", category=category.name, images=len(category.images)):
+                        image_count_finished = self.render_checkpoint_part(
+                            category, prepared_images, image_count_finished, image_count_total, update_progress_callback
+                        )
+                else:
+                    with self.tracer.span("category", category=category.name, images=len(category.images)):
+                        image_count_finished = self.builder.add_page(
+                            category.add_to_pdf(prepared_images, image_count_finished, image_count_total, update_progress_callback), new_page=False
+                        )
+
+                self.record_category(category, first_page)
+
+        self.recompressed.update(preparer.recompressed)
+        self.skipped.extend(preparer.skipped)
+
+    def add_categories_parallel(self, image_categories, update_progress_callback):
+        # Every category is rendered to its own part by a worker process, the parts are appended in order.
+        # With a checkpoint, the parts are kept there until the output is complete.
+        with self.open_previous_output() as previous_output, \
+                (contextlib.nullcontext() if self.checkpoint is not None else tempfile.TemporaryDirectory()) as part_dir, \
+                ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=(self.memory_budget,)) as executor:
+            reusable = self.get_reusable_categories(image_categories, previous_output)
+            resumable = self.get_resumable_categories(image_categories, reusable)
+
+            part_files = {
+                category.name: self.checkpoint.get_part_file(category) if part_dir is None else os.path.join(part_dir, f"{i}.pdf")
+                for i, category in enumerate(image_categories)
+            }
+            futures = {
+                category.name: executor.submit(
+                    render_category_part, category, part_files[category.name], self.target_dpi, self.cache_dir,
+                    self.prefetcher, self.recompress_quality, self.tracer.enabled, self.preview, self.cache_max_bytes
+                )
+                for category in image_categories if category.name not in reusable and category.name not in resumable
+            }
+
+            try:
+                self._append_category_parts(
+                    image_categories, reusable, resumable, previous_output, futures, part_files, update_progress_callback
+                )
+            except BaseException:
+                # Chapters still rendering are completed, so they are not lost for the next run
+                executor.shutdown(cancel_futures=True)
+                if self.checkpoint is not None:
+                    for category in image_categories:
+                        future = futures.get(category.name)
+                        if future is not None and future.done() and not future.cancelled() and future.exception() is None:
+                            part = future.result()
+                            self.checkpoint.add_chapter(category, part["bookmarks"], part["page_count"])
+                raise
+
+    def wait_for_part(self, future):
+        # Polls, so a cancel does not wait for the chapter to finish
+        while not wait([future], timeout=0.2).done:
+            self.controller.check()
+        return future.result()
+
+    def _append_category_parts(self, image_categories, reusable, resumable, previous_output, futures, part_files,
+                               update_progress_callback):
+        image_count_total = sum(len(c.images) for c in image_categories)
+        image_count_finished = 0
+
+        for category in image_categories:
+            first_page = self.builder.current_page - 1
+            image_count_finished += len(category.images)
+
+            if category.name in reusable:
+                self.reuse_category(category, reusable[category.name], previous_output)
+                self.report_category(category, "unverändert übernommen", image_count_finished, image_count_total, update_progress_callback)
+                self.record_category(category, first_page)
+                continue
+
+            if category.name in resumable:
+                self.resume_category(category, resumable[category.name])
+                self.report_category(category, "aus Zwischenstand übernommen", image_count_finished, image_count_total, update_progress_callback)
+                self.record_category(category, first_page)
+                continue
+
+            part = self.wait_for_part(futures[category.name])
+            self.tracer.extend(part["events"])
+            self.savings = [total + value for total, value in zip(self.savings, part["savings"])]
+            self.recompressed.update(part["recompressed"])
+            if self.cache is not None:
+                self.cache.hits += part["cache"][0]
+                self.cache.misses += part["cache"][1]
+            for path, reason in part["skipped"]:
+                print(f"Warnung: Bild '{path}' übersprungen: {reason}", file=sys.stderr)
+            self.skipped.extend(part["skipped"])
+
+            part_file = part_files[category.name]
+            self.append_part_file(part_file, part["bookmarks"], part["page_count"])
+            if self.checkpoint is not None:
+                self.checkpoint.add_chapter(category, part["bookmarks"], part["page_count"])
+            else:
+                os.remove(part_file)
+            del futures[category.name]
+
+            self.report_category(category, "hinzugefügt", image_count_finished, image_count_total, update_progress_callback)
+            self.record_category(category, first_page)
+
+    def get_savings(self):
+        shared_images, shared_image_bytes = self.builder.get_shared_images()
+        return {
+            "shared_images": shared_images + self.savings[0],
+            "shared_image_bytes": shared_image_bytes + self.savings[1],
+            "recompressed_images": len(self.recompressed),
+            "recompressed_bytes": sum(self.recompressed.values()),
+        }
+
+    def format_savings(self):
+        savings = self.get_savings()
+        return (
+            f"Optimierung: {savings['shared_images']} doppelte Bilder geteilt ({savings['shared_image_bytes'] / 1024 ** 2:.1f} MB gespart), "
+            f"{savings['recompressed_images']} verlustfreie Fotos als JPEG ({savings['recompressed_bytes'] / 1024 ** 2:.1f} MB gespart)"
+        )
+
     def create_pdf(self, update_progress_callback):
+        def checked_progress_callback(progress):
+            update_progress_callback(progress)
+            # Progress is reported after every image and chapter, a cancel takes effect there
+            self.controller.check()
+
+        self.controller.check()
+        if self.checkpoint is not None:
+            # Recorded right away, so even a job cancelled in its first chapter can be resumed
+            self.checkpoint.save()
+
+        use_memory_budget(self.memory_budget)
+        try:
+            with profile(self.profile_file):
+                self._create_pdf(checked_progress_callback)
+        except BaseException:
+            self.discard_output()
+            raise
+        finally:
+            use_memory_budget(None)
+
+        if self.trace_file is not None:
+            self.tracer.write_chrome_trace(self.trace_file)
+            print(self.tracer.format_summary())
+
+    def discard_output(self):
+        # The previous output stays untouched, only the unfinished one next to it is removed
+        if self.builder_file == self.output_file:
+            return
+        self.builder.discard()
+        if os.path.exists(self.builder_file):
+            os.remove(self.builder_file)
+
+    def _create_pdf(self, update_progress_callback):
         print("Starte PDF Generierung")
         print("Starte Kategorie-Erfassung")
 
         image_categories = self.get_categories()
+        self.image_count = sum(len(c.images) for c in image_categories)
 
         print("Kategorie-Erfassung abgeschlossen")
 
-        self.builder.add_page(
-            PDFBuilder.add_cover_letter
-        )
+        self.plan_layout(image_categories)
+
+        with self.tracer.span("cover"):
+            self.builder.add_page(
+                PDFBuilder.add_cover_letter
+            )
         print("Deckblatt hinzugefügt")
 
-        self.builder.add_page(
-            PDFBuilder.add_index(
-                image_categories
+        with self.tracer.span("index"):
+            self.builder.add_page(
+                PDFBuilder.add_index(
+                    image_categories
+                )
             )
-        )
         print("Inhaltsverzeichnis hinzugefügt")
 
-        image_count_total = sum(len(c.images) for c in image_categories)
-        image_count_finished = 0
-
-        for category in image_categories:
-            image_count_finished = self.builder.add_page(
-                category.add_to_pdf(image_count_finished, image_count_total, update_progress_callback), new_page=False
-            )
+        if self.parallel_categories:
+            self.add_categories_parallel(image_categories, update_progress_callback)
+        else:
+            self.add_categories(image_categories, update_progress_callback)
 
         update_progress_callback(100)
 
         print("PDF speichert ...")
         self.builder.save()
+        if self.builder_file != self.output_file:
+            os.replace(self.builder_file, self.output_file)
+        if self.manifest is not None:
+            self.manifest.save()
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
         print("PDF erfolgreich erstellt")
 
+        if self.cache is not None:
+            print(self.cache)
+        if self.optimize:
+            print(self.format_savings())
+        if self.skipped:
+            print(f"Warnung: {len(self.skipped)} Bilder übersprungen", file=sys.stderr)
+
     @staticmethod
-    def run_img2pdf(input_dir, output_filename, update_progress_callback):
+    def run_img2pdf(input_dir, output_filename, update_progress_callback, controller=None, **options):
         # Create the PDF
-        img2pdf = IMG2PDF(input_dir, output_filename)
+        img2pdf = IMG2PDF(input_dir, output_filename, controller=controller, **options)
+        if img2pdf.checkpoint is not None:
+            # Recorded with the checkpoint, so the job can be resumed from the output file alone
+            img2pdf.checkpoint.job_options = options
         img2pdf.create_pdf(update_progress_callback)
+        return img2pdf
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+
+class Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self.args
+
+    def __exit__(self, *exc_info):
+        self.tracer.add(self.name, self.start, time.perf_counter_ns(), self.args)
+
+
+class Tracer:
+    """
+    Records the duration of every pipeline stage, with arguments like the image path or the byte count.
+
+    Events are plain tuples (name, start_ns, end_ns, pid, tid, args), so events recorded by a worker
+    process can be sent back and merged into the tracer of the main process.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+
+    def span(self, name, **args):
+        """Context manager timing its block, the args dict it returns can still be extended inside."""
+        return Span(self, name, args)
+
+    def add(self, name, start, end, args):
+        self.events.append((name, start, end, os.getpid(), threading.get_ident(), args))
+
+    def extend(self, events):
+        self.events.extend(events)
+
+    def get_stage_totals(self):
+        stages = {}
+        for name, start, end, _, _, args in self.events:
+            stage = stages.setdefault(name, {"count": 0, "seconds": 0, "bytes": 0})
+            stage["count"] += 1
+            stage["seconds"] += (end - start) / 1e9
+            stage["bytes"] += args.get("bytes", 0)
+        for stage in stages.values():
+            stage["seconds"] = round(stage["seconds"], 4)
+        return stages
+
+    def format_summary(self):
+        lines = [f"{'Stufe':<12}{'Anzahl':>8}{'Gesamt s':>11}{'Mittel ms':>11}{'Bytes':>14}"]
+        for name, stage in sorted(self.get_stage_totals().items(), key=lambda s: -s[1]["seconds"]):
+            mean_ms = stage["seconds"] / stage["count"] * 1000
+            lines.append(f"{name:<12}{stage['count']:>8}{stage['seconds']:>11.3f}{mean_ms:>11.2f}{stage['bytes']:>14}")
+
+        categories = [(args["category"], end - start) for name, start, end, _, _, args in self.events if name == "category"]
+        if categories:
+            lines.append("")
+            lines.append(f"{'Kapitel':<40}{'Gesamt s':>11}")
+            for category, duration in categories:
+                lines.append(f"{category[:39]:<40}{duration / 1e9:>11.3f}")
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path):
+        # Trace event format, opens in chrome://tracing or Perfetto
+        origin = min((start for _, start, _, _, _, _ in self.events), default=0)
+        trace_events = [
+            {
+                "name": name, "cat": "img2pdf", "ph": "X",
+                "ts": (start - origin) / 1000, "dur": (end - start) / 1000,
+                "pid": pid, "tid": tid, "args": args,
+            }
+            for name, start, end, pid, tid, args in self.events
+        ]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+
+class NullSpan:
+    __slots__ = ()
+    args = {}  # Shared, written values are never read
+
+    def __enter__(self):
+        return self.args
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullTracer:
+    """Disabled tracer, every call is a no-op, so the instrumented code stays cheap."""
+    enabled = False
+    events = ()
+    _span = NullSpan()
+
+    def span(self, name, **args):
+        return self._span
+
+    def add(self, name, start, end, args):
+        pass
+
+    def extend(self, events):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+@contextlib.contextmanager
+def profile(profile_file):
+    """Profiles the block with cProfile and dumps the stats to profile_file, does nothing without a file."""
+    if profile_file is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
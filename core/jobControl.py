@@ -0,0 +1,131 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import signal
+import threading
+
+from core.buildManifest import BuildManifest
+
+
+# Bump when the checkpoint records change, older checkpoints are started over
+CHECKPOINT_VERSION = 1
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobController:
+    """
+    Cancellation of a running conversion.
+
+    cancel may be called from any thread or a signal handler, the conversion checks for it after every image
+    and stops with JobCancelled. Completed chapters stay in the checkpoint, if one is kept.
+    """
+
+    def __init__(self, event=None):
+        # A multiprocessing event shares the cancellation with worker processes
+        self._cancelled = event if event is not None else threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled("Abgebrochen")
+
+    @contextlib.contextmanager
+    def handle_signals(self, signals=(signal.SIGINT, signal.SIGTERM)):
+        """Cancels on the given signals instead of terminating. Handlers can only be set in the main thread."""
+        if threading.current_thread() is not threading.main_thread():
+            yield self
+            return
+
+        previous = {signum: signal.signal(signum, lambda *_: self.cancel()) for signum in signals}
+        try:
+            yield self
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+
+class Checkpoint:
+    """
+    Chapters completed by an unfinished run, kept as PDF parts next to the output.
+
+    Every rendered chapter is recorded as soon as its part is written. A later run with the same options
+    appends the parts of unchanged chapters instead of rendering them again, prepared image streams of the
+    interrupted chapter are kept in the cache of the checkpoint. The checkpoint is removed once the output
+    is complete. The job is recorded as well, so it can be resumed from the output file alone.
+    """
+
+    def __init__(self, output_file, input_dir, options):
+        self.checkpoint_dir = output_file + ".checkpoint"
+        self.checkpoint_file = os.path.join(self.checkpoint_dir, "checkpoint.json")
+        self.input_dir = input_dir
+        self.options = {"version": CHECKPOINT_VERSION, **options}
+        self.job_options = None  # Set by the caller to allow resuming the job
+        self.chapters = self._load()
+        self.resumed = 0
+
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+    @property
+    def cache_dir(self):
+        return os.path.join(self.checkpoint_dir, "cache")
+
+    def _load(self):
+        checkpoint = load_checkpoint(self.checkpoint_dir)
+        if checkpoint is None or checkpoint.get("options") != self.options:
+            return {}
+        return checkpoint["chapters"]
+
+    def get_part_file(self, category):
+        # Chapter names may contain any character, the part is named by their hash
+        return os.path.join(self.checkpoint_dir, hashlib.sha1(category.name.encode("utf-8")).hexdigest() + ".pdf")
+
+    def get_resumable(self, category):
+        entry = self.chapters.get(category.name)
+        # Parts of empty chapters used to be recorded without their bookmark, they are rendered again
+        if (entry is not None and entry["files"] == BuildManifest.get_category_files(category)
+                and category.name in entry["bookmarks"] and os.path.exists(self.get_part_file(category))):
+            return entry
+        return None
+
+    def add_chapter(self, category, bookmarks, page_count):
+        self.chapters[category.name] = {
+            "files": BuildManifest.get_category_files(category),
+            "bookmarks": bookmarks,
+            "page_count": page_count,
+        }
+        self.save()
+
+    def save(self):
+        checkpoint = {
+            "options": self.options,
+            "job": {"input_dir": self.input_dir, "options": self.job_options},
+            "chapters": self.chapters,
+        }
+
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f, indent=1)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def remove(self):
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+
+
+def load_checkpoint(checkpoint_dir):
+    try:
+        with open(os.path.join(checkpoint_dir, "checkpoint.json"), encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return checkpoint if checkpoint.get("options", {}).get("version") == CHECKPOINT_VERSION else None
@@ -0,0 +1,161 @@
+from array import array
+
+from reportlab.lib.pagesizes import letter, legal, A3, A4, A5, landscape, portrait
+
+
+PAGE_SIZES = {"letter": letter, "legal": legal, "a3": A3, "a4": A4, "a5": A5}
+ORIENTATIONS = ("portrait", "landscape", "auto")
+# Images per page: columns and rows on a portrait page, swapped on a landscape page
+GRIDS = {1: (1, 1), 2: (1, 2), 4: (2, 2), 6: (2, 3)}
+IMAGE_MARGIN = 0.8
+
+# Fields of one placement in ChapterLayout.placements
+PAGE, X, Y, WIDTH, HEIGHT, CELL_X, CELL_WIDTH = range(7)
+PLACEMENT_FIELDS = 7
+
+
+class LayoutOptions:
+    def __init__(self, images_per_page=2, page_size="letter", orientation="portrait", fit_grid=False):
+        if images_per_page not in GRIDS:
+            raise ValueError(f"Ungültige Anzahl Bilder pro Seite: {images_per_page} (erlaubt: {', '.join(map(str, GRIDS))})")
+        if page_size.lower() not in PAGE_SIZES:
+            raise ValueError(f"Ungültiges Seitenformat: '{page_size}' (erlaubt: {', '.join(PAGE_SIZES)})")
+        if orientation not in ORIENTATIONS:
+            raise ValueError(f"Ungültige Ausrichtung: '{orientation}' (erlaubt: {', '.join(ORIENTATIONS)})")
+
+        self.images_per_page = images_per_page
+        self.page_size = page_size.lower()
+        self.orientation = orientation
+        # Choose the arrangement of the grid that shows the images of the chapter the largest
+        self.fit_grid = fit_grid
+
+    def to_dict(self):
+        return {
+            "images_per_page": self.images_per_page,
+            "page_size": self.page_size,
+            "orientation": self.orientation,
+            "fit_grid": self.fit_grid,
+        }
+
+    @staticmethod
+    def from_dict(options):
+        return LayoutOptions(**options) if options is not None else LayoutOptions()
+
+
+class ChapterLayout:
+    """
+    Pages and image placements of one chapter.
+
+    Every image has PLACEMENT_FIELDS integers in placements: its absolute page number, the image box and
+    the horizontal extent of its grid cell, which centers the caption.
+    """
+    __slots__ = ("first_page", "page_count", "page_size", "grid", "placements")
+
+    def __init__(self, first_page, page_count, page_size, grid, placements):
+        self.first_page = first_page
+        self.page_count = page_count
+        self.page_size = page_size
+        self.grid = grid
+        self.placements = placements
+
+    def get_placement(self, index):
+        start = index * PLACEMENT_FIELDS
+        return self.placements[start:start + PLACEMENT_FIELDS]
+
+    def get_pages(self):
+        """Yields the image indices of every page."""
+        images_per_page = self.grid[0] * self.grid[1]
+        image_count = len(self.placements) // PLACEMENT_FIELDS
+        for start in range(0, image_count, images_per_page):
+            yield range(start, min(start + images_per_page, image_count))
+
+
+def fit_image(image_size, cell_width, cell_height, x_offset=0, y_offset=0, margin=IMAGE_MARGIN):
+    # Largest size keeping the aspect ratio, centered in the cell
+    img_width, img_height = image_size
+    scaling_coeff = min(cell_height / img_height, cell_width / img_width) * margin
+    width, height = img_width * scaling_coeff, img_height * scaling_coeff
+
+    x = (cell_width - width) // 2
+    y = (cell_height - height) // 2
+    return tuple(map(round, (x + x_offset, y + y_offset, width, height)))
+
+
+def get_page_size(options, image_sizes):
+    page_size = PAGE_SIZES[options.page_size]
+    if options.orientation == "auto":
+        landscape_count = sum(1 for width, height in image_sizes if width > height)
+        portrait_count = sum(1 for width, height in image_sizes if height > width)
+        return landscape(page_size) if landscape_count > portrait_count else portrait(page_size)
+    return landscape(page_size) if options.orientation == "landscape" else portrait(page_size)
+
+
+def get_cell_size(page_size, grid, header_height):
+    page_width, page_height = page_size
+    columns, rows = grid
+    return page_width // columns, (page_height - header_height) // rows
+
+
+def get_grid(options, page_size, image_sizes, header_height):
+    columns, rows = GRIDS[options.images_per_page]
+    default_grid = (rows, columns) if page_size[0] > page_size[1] else (columns, rows)
+    if not options.fit_grid or not image_sizes:
+        return default_grid
+
+    def get_shown_area(grid):
+        cell_width, cell_height = get_cell_size(page_size, grid, header_height)
+        return sum(w * h for _, _, w, h in (fit_image(size, cell_width, cell_height) for size in image_sizes))
+
+    n = options.images_per_page
+    grids = [default_grid] + [(c, n // c) for c in range(1, n + 1) if n % c == 0 and (c, n // c) != default_grid]
+    return max(grids, key=get_shown_area)  # The first, i.e. the default grid wins ties
+
+
+def plan_chapter(image_sizes, options, first_page, header_height):
+    """Plans the pages of a chapter from the display sizes of its images."""
+    page_size = get_page_size(options, image_sizes)
+    grid = get_grid(options, page_size, image_sizes, header_height)
+    columns, rows = grid
+    cell_width, cell_height = get_cell_size(page_size, grid, header_height)
+    images_per_page = columns * rows
+
+    placements = array("i")
+    for i, image_size in enumerate(image_sizes):
+        page_index, cell = divmod(i, images_per_page)
+        row, column = divmod(cell, columns)
+        # Cells are filled from the top left, the PDF y axis points up
+        x_offset, y_offset = column * cell_width, (rows - row - 1) * cell_height
+        placements.extend((first_page + page_index, *fit_image(image_size, cell_width, cell_height, x_offset, y_offset),
+                           round(x_offset), round(cell_width)))
+
+    page_count = (len(image_sizes) + images_per_page - 1) // images_per_page
+    return ChapterLayout(first_page, page_count, page_size, grid, placements)
+
+
+class LayoutPlan:
+    """Layout of the whole document, computed from image metadata before anything is rendered."""
+
+    def __init__(self, options=None, chapter_options=None):
+        self.options = options or LayoutOptions()
+        self.chapter_options = chapter_options or {}
+        self.chapters = {}
+        self.page_count = 0
+
+    def get_options(self, chapter_name):
+        return self.chapter_options.get(chapter_name, self.options)
+
+    def plan(self, chapters, first_page, header_height):
+        """chapters are (name, image display sizes) pairs in document order, first_page is the page of the first one."""
+        page = first_page
+        for name, image_sizes in chapters:
+            layout = plan_chapter(image_sizes, self.get_options(name), page, header_height)
+            self.chapters[name] = layout
+            page += layout.page_count
+        self.page_count = page - first_page
+        return self
+
+    def to_dict(self):
+        return {
+            "options": self.options.to_dict(),
+            "chapters": {name: options.to_dict() for name, options in self.chapter_options.items()},
+        }
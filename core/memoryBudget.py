@@ -0,0 +1,43 @@
+import contextlib
+import multiprocessing
+
+
+UNIT = 1024 ** 2
+
+
+class ImageMemoryError(Exception):
+    pass
+
+
+class MemoryBudget:
+    """
+    Memory for decoding images, shared by all worker processes of a run.
+
+    The budget is a counting semaphore of 1 MiB units. A decode reserves the units it needs, so a few huge
+    images wait for each other, while small ones still run side by side. The semaphore can only be handed
+    to worker processes when they are started, e.g. as initializer argument of the pool.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.units = max(1, max_bytes // UNIT)
+        self._semaphore = multiprocessing.BoundedSemaphore(self.units)
+        # Units are taken one by one, a single reserving process at a time can not deadlock with another
+        self._lock = multiprocessing.Lock()
+
+    def check(self, nbytes):
+        if nbytes > self.max_bytes:
+            raise ImageMemoryError(f"benötigt {nbytes / UNIT:.0f} MB Speicher, das Budget ist {self.max_bytes / UNIT:.0f} MB")
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes):
+        self.check(nbytes)
+        units = min(self.units, max(1, -(-nbytes // UNIT)))
+        with self._lock:
+            for _ in range(units):
+                self._semaphore.acquire()
+        try:
+            yield
+        finally:
+            for _ in range(units):
+                self._semaphore.release()
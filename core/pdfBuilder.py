@@ -1,11 +1,16 @@
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
+from reportlab.pdfbase import pdfdoc, pdfmetrics
 from reportlab.lib import colors
 
 import os
-from PIL import Image
+import io
+import functools
 from abc import ABC, abstractmethod
 
+from core.pdfStream import PDFStreamWriter
+from core.instrumentation import NULL_TRACER
+
 
 IMG_FORMAT_EXT = ('.png', '.jpg', '.jpeg')
 
@@ -23,14 +28,95 @@ class FontCollection:
     DEFAULT_H1 = Font("Helvetica-Bold", 20)
 
 
+@functools.lru_cache(maxsize=4096)
+def get_string_width(text, font_name, font_size):
+    # Captions, headers and index lines repeat a lot, their widths are measured once
+    return pdfmetrics.stringWidth(text, font_name, font_size)
+
+
+def preload_fonts():
+    # Font metrics are parsed on first use, e.g. while the window is idle instead of during the first page
+    for font in (FontCollection.DEFAULT, FontCollection.DEFAULT_BOLD, FontCollection.DEFAULT_H1):
+        pdfmetrics.getFont(font.name)
+
+
 class PDFBuilder:
-    def __init__(self, output_file):
+    def __init__(self, output_file, stream_pages=None, tracer=NULL_TRACER):
         self.width_page, self.height_page = letter
-        self.canvas = canvas.Canvas(output_file, (self.width_page, self.height_page))
+        self.tracer = tracer
+
+        # In streaming mode every stream_pages pages are rendered by a fresh canvas and flushed to the output file
+        self.stream_pages = stream_pages
+        self.writer = PDFStreamWriter(output_file) if stream_pages else None
+        self.part_bookmarks = {}
+        self.part_links = []
+        self.part_page_count = 0
+        self.page_bookmarks = []  # Set on the current page of the in-memory canvas
+
+        # Images drawn again from an XObject already embedded in the current canvas
+        self.shared_images = 0
+        self.shared_image_bytes = 0
+
+        self.canvas = self._new_canvas(output_file)
 
         self.font_default = FontCollection.DEFAULT
         self.current_font = None
         self.current_page = 1
+        self.page_count = None  # Known once saved
+        self.page_break_code = None  # Length of the page code right after the last page break
+
+    def _new_canvas(self, output_file=None):
+        if self.writer is not None:
+            output_file = io.BytesIO()
+        return canvas.Canvas(output_file, (self.width_page, self.height_page))
+
+    def flush_part(self):
+        if self.part_page_count == 0:
+            # Bookmarks without a page of their own (empty trailing category) point after the last page
+            for name in self.part_bookmarks:
+                self.writer.destinations[name] = self.writer.page_count
+            self.part_bookmarks = {}
+            return
+
+        with self.tracer.span("flush", pages=self.part_page_count) as span:
+            pdf_data = self.canvas.getpdfdata()
+            span["bytes"] = len(pdf_data)
+            self.writer.add_part(pdf_data, self.part_bookmarks, self.part_links)
+        self.canvas = self._new_canvas()
+        self.part_bookmarks = {}
+        self.part_links = []
+        self.part_page_count = 0
+
+    def append_part(self, pdf_data, bookmarks=None, page_count=0, page_range=None):
+        # Appends pages rendered elsewhere, e.g. by a category worker process or a previous run
+        self.flush_part()
+        with self.tracer.span("append", pages=page_count):
+            self.writer.add_part(pdf_data, bookmarks, page_range=page_range)
+        self.current_page += page_count
+
+    def bookmark_page(self, name):
+        if self.writer is None:
+            self.canvas.bookmarkPage(name)
+            self.page_bookmarks.append(name)
+        else:
+            self.part_bookmarks[name] = self.part_page_count
+
+    def link_rect(self, contents, name, rect):
+        if self.writer is None:
+            self.canvas.linkRect(contents, name, rect, relative=False)
+        else:
+            self.part_links.append((self.part_page_count, rect, name))
+
+    def set_page_size(self, page_size):
+        # Applies to the current page and all following ones
+        self.width_page, self.height_page = page_size
+        self.canvas.setPageSize(page_size)
+
+    def get_shared_images(self):
+        # Shared within a canvas and, in streaming mode, between the parts
+        if self.writer is None:
+            return self.shared_images, self.shared_image_bytes
+        return self.shared_images + self.writer.shared_images, self.shared_image_bytes + self.writer.shared_image_bytes
 
     def transform_y_top(self, y_value):
         return self.height_page - y_value
@@ -68,12 +154,85 @@ class PDFBuilder:
 
     def string_width_current(self, text):
         assert self.current_font is not None, "No font has been explicitly set."
-        return self.canvas.stringWidth(text, self.current_font.name, self.current_font.size)
+        return get_string_width(text, self.current_font.name, self.current_font.size)
+
+    def get_padded_line(self, text_left, text_right, width, filler="."):
+        # Both texts filled up to width with the filler, e.g. for index lines
+        length_left = self.string_width_current(text_left)
+        length_right = self.string_width_current(text_right)
+        length_filler = self.string_width_current(filler)
+        filler_count = round((width - length_left - length_right) / length_filler)
+
+        # Character widths add up, so the padded line is not measured again
+        return text_left + filler * filler_count + text_right, length_left + filler_count * length_filler + length_right
+
+    def link_file(self, file_name, page_index, rect):
+        # Link to a page of another PDF file, e.g. of a volume next to this one. Not available in streaming mode.
+        assert self.writer is None, "Links to other files are only supported by the in-memory canvas."
+        action = pdfdoc.PDFDictionary()
+        action["S"] = pdfdoc.PDFName("GoToR")
+        action["F"] = pdfdoc.PDFString(file_name)
+        action["D"] = pdfdoc.PDFArray([page_index, pdfdoc.PDFName("Fit")])
+
+        annotation = pdfdoc.PDFDictionary()
+        annotation["Type"] = pdfdoc.PDFName("Annot")
+        annotation["Subtype"] = pdfdoc.PDFName("Link")
+        annotation["Rect"] = pdfdoc.PDFArray(rect)
+        annotation["Border"] = pdfdoc.PDFArray([0, 0, 0])
+        annotation["A"] = action
+        self.canvas._addAnnotation(annotation)
 
     def draw_string_width_centered(self, y, text):
         text_width = self.string_width_current(text)
         self.canvas.drawString(self.get_width_centered_page(text_width), y, text)
 
+    def draw_string_centered(self, x, width, y, text):
+        # Centered between x and x + width
+        text_width = self.string_width_current(text)
+        self.canvas.drawString(x + self.get_el_centered(width, text_width), y, text)
+
+    def draw_image_stream(self, image_stream, x, y, width, height):
+        # Like canvas.drawImage, but registers an already encoded stream, so ReportLab never decodes the image
+        with self.tracer.span("draw", bytes=len(image_stream.data)):
+            self._draw_image_stream(image_stream, x, y, width, height)
+
+    def _draw_image_stream(self, image_stream, x, y, width, height):
+        c = self.canvas
+        c._currentPageHasImages = 1
+
+        reg_name = c._doc.getXObjectName(image_stream.digest)
+        if reg_name not in c._doc.idToObject:
+            img_obj = pdfdoc.PDFImageXObject(image_stream.digest)
+            img_obj.width, img_obj.height = image_stream.width, image_stream.height
+            img_obj.bitsPerComponent = 8
+            img_obj.colorSpace = image_stream.color_space
+            img_obj._filters = image_stream.filters
+            img_obj.streamContent = image_stream.data
+            img_obj.mask = None
+
+            c._setXObjects(img_obj)
+            c._doc.Reference(img_obj, reg_name)
+            c._doc.addForm(image_stream.digest, img_obj)
+        else:
+            self.shared_images += 1
+            self.shared_image_bytes += len(image_stream.data)
+
+        c.saveState()
+        c.translate(x, y)
+        c.scale(width, height)
+        c._code.append(f"/{reg_name} Do")
+        c.restoreState()
+        c._formsinuse.append(image_stream.digest)
+
+    def draw_placeholder(self, x, y, width, height, text):
+        c = self.canvas
+        c.saveState()
+        c.setStrokeColor(colors.grey)
+        c.setDash(4, 4)
+        c.rect(x, y, width, height)
+        c.restoreState()
+        self.draw_string_centered(x, width, y + self.get_el_centered(height, self.current_font.size), text)
+
     def add_page(self, page_constructor, new_page=True, apply_default_font=True):
         r = page_constructor(self.canvas, self)
 
@@ -87,12 +246,44 @@ class PDFBuilder:
         self.canvas.showPage()
         self.current_font = None
         self.current_page += 1
+        self.page_bookmarks = []
+
+        if self.writer is not None:
+            self.part_page_count += 1
+            if self.part_page_count >= self.stream_pages:
+                self.flush_part()
 
         if apply_default_font:
             self.apply_default_font()
+        self.page_break_code = len(self.canvas._code)
+
+    def discard(self):
+        # Closes the output of an unfinished run, e.g. a cancelled one
+        if self.writer is not None:
+            self.writer.file.close()
 
     def save(self):
-        self.canvas.save()
+        with self.tracer.span("save"):
+            self._save()
+
+    def _save(self):
+        if self.writer is None:
+            # Like in streaming mode, a page without content after the last page break is not saved
+            if len(self.canvas._code) == self.page_break_code:
+                self.canvas._code.clear()
+                # Bookmarks set on it (empty trailing category) point to the last page instead
+                last_page = pdfdoc.PDFObjectReference(f"Page{self.canvas._doc.pageCounter - 1}")
+                for name in self.page_bookmarks:
+                    self.canvas._bookmarkReference(name).setPage(last_page)
+            self.canvas.save()
+            self.page_count = self.canvas.getPageNumber() - 1
+            return
+
+        # Only completed pages are streamed, the state set up after the last page break would add a blank page
+        self.canvas._code.clear()
+        self.flush_part()
+        self.writer.close()
+        self.page_count = self.writer.page_count
 
     @staticmethod
     def add_cover_fields(y_cursor):
@@ -196,28 +387,65 @@ class PDFBuilder:
             y_cursor -= 100
             builder.apply_default_font()
 
-            category_first_page = builder.current_page + 1
-
             for category in categories:
                 y_cursor -= (builder.current_font.size + 2)
 
-                text_category = category.name
-                length_text_category = builder.string_width_current(text_category)
-                text_page = f"Seite: {str(category_first_page).zfill(3)}"
-                length_text_page = builder.string_width_current(text_page)
-                filler = "."
-                length_filler = builder.string_width_current(filler)
-                filler_full_length = filler * round((width_header - length_text_category - length_text_page) / length_filler)
-
-                text_padded = text_category + filler_full_length + text_page
-                text_width = builder.string_width_current(text_padded)
+                # Exact page numbers from the layout plan
+                text_padded, text_width = builder.get_padded_line(
+                    category.name, f"Seite: {str(category.layout.first_page).zfill(3)}", width_header
+                )
 
                 x_string = x_header + PDFBuilder.get_el_centered(width_header, text_width)
                 c.drawString(x_string, y_cursor, text_padded)
                 # Link zu der Seite
-                c.linkRect(text_padded, category.name, (x_string, y_cursor, x_string + text_width, y_cursor + builder.current_font.size), relative=False)
+                builder.link_rect(text_padded, category.name, (x_string, y_cursor, x_string + text_width, y_cursor + builder.current_font.size))
+        return __inner
 
-                category_first_page += category.get_page_count()
+
+    @staticmethod
+    def add_master_index(volumes, margin=50):
+        """
+        Index of all volumes, every line links to the first page of its chapter in the volume file.
+        volumes are (file name, [(chapter name, first page), ...]) pairs in order, the index continues on further pages.
+        """
+        def __inner(c: canvas.Canvas, builder):
+            builder.apply_font(FontCollection.DEFAULT_H1)
+
+            padding = 30
+            width_header = 400
+            height_header = builder.current_font.size * 3
+            x_header = PDFBuilder.get_el_centered(builder.width_page, width_header)
+            y_cursor = builder.height_page - height_header - padding
+
+            RectTxtField(
+                text="Gesamtinhaltsverzeichnis",
+                x=x_header,
+                y=y_cursor,
+                frame_width=width_header,
+                frame_height=height_header
+            ).draw(c, builder)
+            y_cursor -= 60
+
+            for number, (file_name, chapters) in enumerate(volumes, 1):
+                lines = [(FontCollection.DEFAULT_BOLD, f"Band {number}", os.path.basename(file_name), 1)]
+                lines += [(FontCollection.DEFAULT, name, f"Seite: {str(first_page).zfill(3)}", first_page) for name, first_page in chapters]
+
+                for font, text_left, text_right, page in lines:
+                    builder.apply_font(font)
+                    y_cursor -= builder.current_font.size + 2
+                    if y_cursor < margin:
+                        builder.next_page(apply_default_font=False)
+                        builder.apply_font(font)
+                        y_cursor = builder.height_page - margin
+
+                    text_padded, text_width = builder.get_padded_line(text_left, text_right, width_header)
+                    x_string = x_header + PDFBuilder.get_el_centered(width_header, text_width)
+                    builder.canvas.drawString(x_string, y_cursor, text_padded)
+                    builder.link_file(
+                        os.path.basename(file_name), page - 1,
+                        (x_string, y_cursor, x_string + text_width, y_cursor + builder.current_font.size)
+                    )
+                y_cursor -= builder.current_font.size
         return __inner
 
 
@@ -330,25 +558,15 @@ class RectTxtField(FormatElement):
 
 
 class PDFImage(FormatElement):
-    def __init__(self, path):
+    def __init__(self, info):
         super().__init__()
 
-        self.full_name = os.path.split(path)[-1]
+        # Only metadata is held here, pixels are decoded when the image is placed on the page
+        self.info = info
+        self.path = info.path
+        self.full_name = os.path.split(self.path)[-1]
         self.name = ".".join(self.full_name.split(".")[:-1])
         self.ext = self.full_name.split(".")[-1]
-        self.img = Image.open(path)
-        self.path = path
-
-    def get_format(self, max_width, max_height, margin=0.8, x_offset=0, y_offset=0):
-        # Calculate size and position
-        scaling_coeff = min(max_height / self.img.height, max_width / self.img.width) * margin
-        width, height = self.img.width * scaling_coeff, self.img.height * scaling_coeff
-
-        x = PDFBuilder.get_el_centered(max_width, width)
-        y = PDFBuilder.get_el_centered(max_height, height)
-        # y_position = height - 150 - ((image_height + 50) * j) # Account for text box?
-
-        return tuple(map(round, (x + x_offset, y + y_offset, width, height)))
 
     # TODO: implement
     def get_frame(self):
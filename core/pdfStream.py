@@ -0,0 +1,308 @@
+import hashlib
+import re
+
+
+CATALOG_NUM = 1
+PAGES_NUM = 2
+
+_XREF_ENTRY = re.compile(rb"(\d{10}) (\d{5}) ([nf])")
+_OBJ_HEADER = re.compile(rb"(\d+) 0 obj\s*")
+_STREAM_OR_END = re.compile(rb"stream\r?\n|endobj")
+_REF = re.compile(rb"(\d+) 0 R")
+_REF_OR_STRING = re.compile(rb"(\d+) 0 R|<<|\(|<")
+_LENGTH = re.compile(rb"/Length (\d+)")
+_TYPE = re.compile(rb"/Type /(\w+)")
+_SUBTYPE = re.compile(rb"/Subtype /(\w+)")
+# Font resource dictionary of a page or form, e.g. << /F1 5 0 R /F2 7 0 R >>
+_FONT_RESOURCES = re.compile(rb"<<\s*(?:/F\d+ \d+ 0 R\s*)+>>")
+_ARRAY_ENTRY = rb"/%s \[([^\]]*)\]"
+_REF_ENTRY = rb"/%s (\d+) 0 R"
+
+# Small resource objects, that are identical in every part and therefore shared in the output
+SHARED_TYPES = (b"Font", b"Encoding")
+# Identical images and forms (e.g. the appearance of a form field) of different parts are written once as well
+SHARED_XOBJECTS = (b"Image", b"Form")
+
+
+def _skip_literal_string(data, start):
+    depth = 0
+    i = start
+    while i < len(data):
+        char = data[i:i + 1]
+        if char == b"\\":
+            i += 1
+        elif char == b"(":
+            depth += 1
+        elif char == b")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    raise ValueError("Unterminated string in PDF object")
+
+
+def renumber_refs(body, map_ref):
+    """Rewrites every indirect reference in an object body, strings are left untouched."""
+    parts = []
+    pos = 0
+    while True:
+        m = _REF_OR_STRING.search(body, pos)
+        if m is None:
+            break
+
+        if m.group(1) is not None:
+            parts.append(body[pos:m.start()])
+            parts.append(b"%d 0 R" % map_ref(int(m.group(1))))
+            end = m.end()
+        elif m.group(0) == b"<<":
+            end = m.end()
+            parts.append(body[pos:end])
+        elif m.group(0) == b"(":
+            end = _skip_literal_string(body, m.start())
+            parts.append(body[pos:end])
+        else:
+            end = body.index(b">", m.start()) + 1
+            parts.append(body[pos:end])
+        pos = end
+
+    parts.append(body[pos:])
+    return b"".join(parts)
+
+
+def get_refs(body, key):
+    m = re.search(_ARRAY_ENTRY % key, body)
+    return [int(num) for num in _REF.findall(m.group(1))] if m else []
+
+
+def get_ref(body, key):
+    m = re.search(_REF_ENTRY % key, body)
+    return int(m.group(1)) if m else None
+
+
+class PDFPartReader:
+    """
+    Random access to the objects of a PDF written by ReportLab (classic xref table, direct stream lengths).
+
+    data may be bytes or a memory-mapped file, only the objects read are loaded.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+        startxref = data.rfind(b"startxref")
+        xref_start = int(data[startxref:startxref + 40].split()[1])
+        trailer_start = data.find(b"trailer", xref_start)
+        header = data[xref_start:trailer_start].split(b"\n", 2)[1]
+        first_num = int(header.split()[0])
+
+        self.offsets = {
+            first_num + i: int(offset)
+            for i, (offset, _, state) in enumerate(_XREF_ENTRY.findall(data, xref_start, trailer_start))
+            if state == b"n"
+        }
+        self.root = get_ref(data[trailer_start:], b"Root")
+
+    def read_object(self, num):
+        """Returns the object body and its stream data, or None for objects without a stream."""
+        header = _OBJ_HEADER.match(self.data, self.offsets[num])
+        m = _STREAM_OR_END.search(self.data, header.end())
+        body = self.data[header.end():m.start()].rstrip()
+
+        if m.group(0) == b"endobj":
+            return body, None
+
+        length = int(_LENGTH.search(body).group(1))
+        return body, self.data[m.end():m.end() + length]
+
+    @property
+    def page_list(self):
+        if not hasattr(self, "_page_list"):
+            self._page_list = list(self.get_pages())
+        return self._page_list
+
+    def get_pages(self, num=None):
+        """Yields the page object numbers in order, together with the page tree nodes they hang on."""
+        if num is None:
+            num = get_ref(self.read_object(self.root)[0], b"Pages")
+
+        body, _ = self.read_object(num)
+        for kid in get_refs(body, b"Kids"):
+            kid_body, _ = self.read_object(kid)
+            if _TYPE.search(kid_body).group(1) == b"Pages":
+                yield from self.get_pages(kid)
+            else:
+                yield kid, num
+
+
+class PDFStreamWriter:
+    """
+    Writes a PDF incrementally from parts, each part being a complete PDF rendered by ReportLab.
+
+    Objects of a part are written to the output file as soon as the part is added, only object offsets
+    and page numbers are kept in memory. Bookmarks and links are tracked per page and resolved on close,
+    so a link may point to a page, that has not been written yet.
+    """
+
+    def __init__(self, output_file):
+        self.file = open(output_file, "wb") if isinstance(output_file, str) else output_file
+        self.offsets = {}
+        self.next_num = PAGES_NUM + 1
+
+        self.pages = []
+        self.destinations = {}
+        self.links = []  # Reserved annotation number, link rect and target name
+        self.shared = {}
+        # Identical images of different parts are written once, e.g. a logo in every chapter. Counts images only.
+        self.shared_images = 0
+        self.shared_image_bytes = 0
+        self.form_fields = []
+        self.acroform = None
+
+        self.file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    @property
+    def page_count(self):
+        return len(self.pages)
+
+    def _alloc(self):
+        num = self.next_num
+        self.next_num += 1
+        return num
+
+    def _write_object(self, num, body, stream=None):
+        self.offsets[num] = self.file.tell()
+        self.file.write(b"%d 0 obj\n" % num)
+        self.file.write(body)
+        if stream is not None:
+            self.file.write(b"\nstream\n")
+            self.file.write(stream)
+            self.file.write(b"\nendstream")
+        self.file.write(b"\nendobj\n")
+
+    def _copy_object(self, part, num, mapping):
+        if num in mapping:
+            return mapping[num]
+
+        body, stream = part.read_object(num)
+        m = _TYPE.search(body)
+        if stream is None and (m is not None and m.group(1) in SHARED_TYPES or m is None and _FONT_RESOURCES.fullmatch(body)):
+            body = renumber_refs(body, lambda n: self._copy_object(part, n, mapping))
+            key = hashlib.sha1(body).digest()
+            if key not in self.shared:
+                self.shared[key] = self._alloc()
+                self._write_object(self.shared[key], body)
+            mapping[num] = self.shared[key]
+            return mapping[num]
+
+        if stream is not None and m is not None and m.group(1) == b"XObject" and _SUBTYPE.search(body).group(1) in SHARED_XOBJECTS:
+            body = renumber_refs(body, lambda n: self._copy_object(part, n, mapping))
+            key = hashlib.sha1(body)
+            key.update(stream)
+            key = key.digest()
+            if key in self.shared:
+                if _SUBTYPE.search(body).group(1) == b"Image":
+                    self.shared_images += 1
+                    self.shared_image_bytes += len(stream)
+            else:
+                self.shared[key] = self._alloc()
+                self._write_object(self.shared[key], body, stream)
+            mapping[num] = self.shared[key]
+            return mapping[num]
+
+        # Reserve the number first, objects may refer back to each other (widget annotation and page)
+        new_num = mapping[num] = self._alloc()
+        body = renumber_refs(body, lambda n: self._copy_object(part, n, mapping))
+        self._write_object(new_num, body, stream)
+        return new_num
+
+    def _copy_page(self, part, num, mapping, annots):
+        new_num = mapping[num] = self._alloc()
+        body, stream = part.read_object(num)
+        body = renumber_refs(body, lambda n: self._copy_object(part, n, mapping))
+
+        if annots:
+            refs = b" ".join(b"%d 0 R" % n for n in annots)
+            if b"/Annots [" in body:
+                body = body.replace(b"/Annots [", b"/Annots [ " + refs, 1)
+            else:
+                body = body.replace(b"<<", b"<< /Annots [ " + refs + b" ]", 1)
+
+        self._write_object(new_num, body, stream)
+        return new_num
+
+    def _copy_acroform(self, part, num, mapping):
+        body, _ = part.read_object(num)
+        fields = get_refs(body, b"Fields")
+        self.form_fields.extend(self._copy_object(part, field, mapping) for field in fields)
+
+        if self.acroform is None:
+            body = re.sub(_ARRAY_ENTRY % b"Fields", b"", body)
+            self.acroform = renumber_refs(body, lambda n: self._copy_object(part, n, mapping))
+
+    def add_part(self, pdf_data, bookmarks=None, links=None, page_range=None):
+        """
+        Appends all pages of a part, or only the pages in page_range (start, stop).
+
+        pdf_data may also be a PDFPartReader, so a document is only parsed once when copied in several ranges.
+        bookmarks maps destination names to page indices within the appended pages,
+        links is a list of (page index within the appended pages, rect, destination name).
+        """
+        part = pdf_data if isinstance(pdf_data, PDFPartReader) else PDFPartReader(pdf_data)
+        mapping = {}
+        first_page = self.page_count
+
+        for name, page_index in (bookmarks or {}).items():
+            self.destinations[name] = first_page + page_index
+
+        page_annots = {}
+        for page_index, rect, name in links or ():
+            annot_num = self._alloc()
+            page_annots.setdefault(page_index, []).append(annot_num)
+            self.links.append((annot_num, rect, name))
+
+        pages = part.page_list if page_range is None else part.page_list[slice(*page_range)]
+        for page_index, (page_num, parent_num) in enumerate(pages):
+            mapping[parent_num] = PAGES_NUM
+            self.pages.append(self._copy_page(part, page_num, mapping, page_annots.get(page_index)))
+
+        if page_range is not None:
+            return
+
+        acroform_num = get_ref(part.read_object(part.root)[0], b"AcroForm")
+        if acroform_num is not None:
+            self._copy_acroform(part, acroform_num, mapping)
+
+    def close(self):
+        for annot_num, rect, name in self.links:
+            if name not in self.destinations:
+                raise ValueError(f"Undefined destination target for '{name}'")
+            # A bookmark set after the last page (empty trailing category) points to the last page
+            page_num = self.pages[min(self.destinations[name], self.page_count - 1)]
+            rect = b" ".join(b"%g" % v for v in rect)
+            self._write_object(
+                annot_num,
+                b"<< /Border [ 0 0 0 ] /Dest [ %d 0 R /Fit ] /Rect [ %s ] /Subtype /Link /Type /Annot >>" % (page_num, rect)
+            )
+
+        kids = b" ".join(b"%d 0 R" % num for num in self.pages)
+        self._write_object(PAGES_NUM, b"<< /Count %d /Kids [ %s ] /Type /Pages >>" % (self.page_count, kids))
+
+        catalog = b"<< /PageMode /UseNone /Pages %d 0 R /Type /Catalog" % PAGES_NUM
+        if self.acroform is not None:
+            acroform_num = self._alloc()
+            fields = b" ".join(b"%d 0 R" % num for num in self.form_fields)
+            self._write_object(acroform_num, self.acroform.replace(b"<<", b"<< /Fields [ %s ]" % fields, 1))
+            catalog += b" /AcroForm %d 0 R" % acroform_num
+        self._write_object(CATALOG_NUM, catalog + b" >>")
+
+        xref_start = self.file.tell()
+        self.file.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_num)
+        for num in range(1, self.next_num):
+            if num in self.offsets:
+                self.file.write(b"%010d 00000 n \n" % self.offsets[num])
+            else:
+                self.file.write(b"0000000000 65535 f \n")
+
+        self.file.write(b"trailer\n<< /Root %d 0 R /Size %d >>\n" % (CATALOG_NUM, self.next_num))
+        self.file.write(b"startxref\n%d\n%%%%EOF\n" % xref_start)
+        self.file.close()
@@ -0,0 +1,166 @@
+import os
+import time
+
+from core.batch import Job, run_job, run_jobs
+from core.img2pdf import DEFAULT_TARGET_DPI, IMGCategory, scan_categories
+from core.imagePrep import PREVIEW_DPI, get_target_size
+from core.layoutPlan import LayoutOptions, LayoutPlan, WIDTH, HEIGHT
+from core.pdfBuilder import PDFBuilder
+
+
+# Cover and index page of every volume
+FRONT_PAGES = 2
+
+# Estimated bytes per pixel of the embedded images: JPEG streams, lossless streams of other sources
+JPEG_BYTES_PER_PIXEL = 0.25
+LOSSLESS_BYTES_PER_PIXEL = 1.5
+
+# Options naming files next to the output
+FILE_OPTIONS = ("scan_index_file", "trace_file", "profile_file")
+
+
+class Volume:
+    def __init__(self, number, output_file):
+        self.number = number
+        self.output_file = output_file
+        self.chapters = []  # (name, first page in the volume)
+        self.page_count = FRONT_PAGES
+        self.size = 0
+
+
+def get_volume_file(output_file, number):
+    stem, ext = os.path.splitext(output_file)
+    return f"{stem}_Band{number}{ext}"
+
+
+def get_volume_files(job, volume_file):
+    # Files kept next to the output, e.g. OUTPUT.scan.json, belong to each volume
+    files = {}
+    for option in FILE_OPTIONS:
+        path = job.options.get(option)
+        if path is not None and path.startswith(job.output_file):
+            files[option] = volume_file + path[len(job.output_file):]
+    return files
+
+
+def estimate_image_bytes(image, placement, target_dpi, lossy=False):
+    # Images are embedded at most at the pixel size of their placement box, never above the source file
+    target_width, target_height = get_target_size(placement[WIDTH], placement[HEIGHT], target_dpi)
+    width, height = image.info.display_size
+    pixels = min(width, target_width) * min(height, target_height)
+    bytes_per_pixel = JPEG_BYTES_PER_PIXEL if lossy or image.info.format == "JPEG" else LOSSLESS_BYTES_PER_PIXEL
+    return min(image.info.size, round(pixels * bytes_per_pixel))
+
+
+class VolumeSplit:
+    """
+    Splits the chapters of a job into volumes of at most max_pages pages and about max_bytes bytes.
+
+    Chapters are never split, a chapter larger than the limits gets a volume of its own. The page count
+    comes from the layout plan, so it is exact. The size is only known once rendered, it is estimated from
+    the pixels every image gets in its planned placement. With per_chapter, every chapter becomes a volume.
+    """
+
+    def __init__(self, max_pages=None, max_bytes=None, per_chapter=False):
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.per_chapter = per_chapter
+
+    @property
+    def enabled(self):
+        return self.per_chapter or self.max_pages is not None or self.max_bytes is not None
+
+    def _exceeds(self, volume, page_count, size):
+        if not volume.chapters:
+            return False
+        if self.per_chapter:
+            return True
+        return ((self.max_pages is not None and volume.page_count + page_count > self.max_pages)
+                or (self.max_bytes is not None and volume.size + size > self.max_bytes))
+
+    def split(self, job):
+        categories = scan_categories(job.input_dir)
+        layout_plan = LayoutPlan(
+            LayoutOptions.from_dict(job.options.get("layout")),
+            {name: LayoutOptions.from_dict(options) for name, options in (job.options.get("chapter_layouts") or {}).items()}
+        )
+        # Pages are numbered per volume, the plan only provides the page count of every chapter
+        layout_plan.plan([(c.name, c.get_image_sizes()) for c in categories], 1, IMGCategory.get_header_height())
+
+        preview = job.options.get("preview", False)
+        target_dpi = job.options.get("target_dpi", DEFAULT_TARGET_DPI)
+        target_dpi = min(target_dpi, PREVIEW_DPI) if preview else target_dpi
+        lossy = preview or job.options.get("optimize", False)
+
+        volumes = []
+        for category in categories:
+            layout = layout_plan.chapters[category.name]
+            page_count = layout.page_count
+            size = sum(
+                estimate_image_bytes(image, layout.get_placement(i), target_dpi, lossy) for i, image in enumerate(category.images)
+            )
+            if not volumes or self._exceeds(volumes[-1], page_count, size):
+                volumes.append(Volume(len(volumes) + 1, get_volume_file(job.output_file, len(volumes) + 1)))
+
+            volume = volumes[-1]
+            volume.chapters.append((category.name, volume.page_count + 1))
+            volume.page_count += page_count
+            volume.size += size
+        return volumes
+
+
+def write_master_index(output_file, volumes):
+    builder = PDFBuilder(output_file)
+    builder.apply_default_font()
+    builder.add_page(PDFBuilder.add_master_index([(volume.output_file, volume.chapters) for volume in volumes]), new_page=False)
+    builder.save()
+    return builder.page_count
+
+
+def run_volumes(job, split, concurrency=1, verbose=False):
+    """
+    Renders the volumes of a job side by side, yields one summary per volume in order of completion.
+
+    The output file of the job becomes the master index, which links to the chapters of all volumes. It is
+    written last and only if all volumes succeeded. Without a split, the job is run as is.
+    """
+    error = job.validate()
+    if error is not None:
+        yield {"input_dir": job.input_dir, "output_file": job.output_file, "status": "error", "error": error}
+        return
+
+    start = time.perf_counter()
+    volumes = split.split(job)
+    if len(volumes) <= 1:
+        yield run_job(job, verbose)
+        return
+
+    volume_jobs = [
+        Job(job.input_dir, volume.output_file, {
+            **job.options,
+            **get_volume_files(job, volume.output_file),
+            "chapters": [name for name, _ in volume.chapters],
+        })
+        for volume in volumes
+    ]
+    failed = False
+    for summary in run_jobs(volume_jobs, concurrency, verbose):
+        failed |= summary["status"] != "ok"
+        yield summary
+
+    summary = {"input_dir": job.input_dir, "output_file": job.output_file, "volumes": [v.output_file for v in volumes]}
+    if failed:
+        yield {**summary, "status": "error", "error": "Gesamtinhaltsverzeichnis nicht erstellt, nicht alle Bände fertig"}
+        return
+    try:
+        pages = write_master_index(job.output_file, volumes)
+    except Exception as e:
+        yield {**summary, "status": "error", "error": f"{type(e).__name__}: {e}"}
+        return
+    yield {
+        **summary,
+        "status": "ok",
+        "pages": pages,
+        "bytes": os.path.getsize(job.output_file),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
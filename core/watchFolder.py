@@ -0,0 +1,218 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from core.batch import run_job
+from core.imageScan import ScanIndex
+from core.jobControl import JobController
+
+
+# inotify event masks, see inotify(7)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT = struct.Struct("iIII")
+
+# Chapter name reported when the changes can not be attributed, e.g. after a queue overflow
+ALL_CHAPTERS = "*"
+
+
+class InotifyWatcher:
+    """
+    Waits for changes in the chapter folders with inotify (Linux only).
+
+    The root and every chapter folder are watched, folders created later are added on the fly.
+    Files directly in the root are ignored, they are not part of the document.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.watches = {}  # Watch descriptor: chapter name, None for the root
+
+        self._add_watch(root, None)
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    self._add_watch(entry.path, entry.name)
+
+    def _add_watch(self, path, chapter):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch '{path}'")
+        self.watches[wd] = chapter
+
+    def wait(self, timeout):
+        """Returns the names of the chapters changed within timeout seconds, an empty set if none."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        data = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, name_length = _EVENT.unpack_from(data, pos)
+            name = os.fsdecode(data[pos + _EVENT.size:pos + _EVENT.size + name_length].rstrip(b"\0"))
+            pos += _EVENT.size + name_length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.add(ALL_CHAPTERS)
+            elif wd not in self.watches:
+                continue
+            elif self.watches[wd] is not None:
+                changed.add(self.watches[wd])
+            elif mask & IN_ISDIR:
+                # A chapter folder was added, removed or renamed
+                changed.add(name)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._add_watch(os.path.join(self.root, name), name)
+                    except OSError:
+                        pass  # Removed again in between
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Waits for changes in the chapter folders by comparing listings every interval seconds.
+
+    Fallback where inotify is not available, e.g. in the Windows executable. On Windows, the listing already
+    contains size and modification time, so no file is opened or stat'ed separately.
+    """
+
+    def __init__(self, root, interval=2.0):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self):
+        snapshot = {}
+        with os.scandir(self.root) as chapters:
+            for chapter in chapters:
+                if not chapter.is_dir():
+                    continue
+                try:
+                    with os.scandir(chapter.path) as entries:
+                        snapshot[chapter.name] = {
+                            entry.name: (entry.stat().st_size, entry.stat().st_mtime_ns) for entry in entries if entry.is_file()
+                        }
+                except OSError:
+                    pass  # Removed in between
+        return snapshot
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval) if timeout is not None else self.interval)
+        snapshot = self._snapshot()
+        changed = {name for name in snapshot.keys() | self.snapshot.keys() if snapshot.get(name) != self.snapshot.get(name)}
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def get_watcher(root, poll_interval=2.0):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as e:
+            # E.g. the inotify watch limit is reached
+            print(f"inotify nicht verfügbar ({e}), Ordner wird abgefragt", file=sys.stderr)
+    return PollingWatcher(root, poll_interval)
+
+
+class FolderWatch:
+    """
+    Keeps the output of a job up to date while files are added to its source folder.
+
+    Changes are collected until no event came for debounce seconds, but at most max_delay seconds after the
+    first one, so a steady stream of uploads still produces a current PDF. Every build is incremental:
+    unchanged chapters are copied from the previous output, only the changed ones are rendered again.
+    The output is replaced atomically, so a complete PDF is always available.
+    A failed build, e.g. because of a file still being uploaded, is retried after max_delay seconds.
+    """
+
+    def __init__(self, job, debounce=2.0, max_delay=30.0, poll_interval=2.0, controller=None, verbose=False):
+        self.job = job
+        self.job.options = {
+            **job.options, "incremental": True, "scan_index_file": job.output_file + ".scan.json",
+        }
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.controller = controller or JobController()
+        self.verbose = verbose
+
+    def _collect(self, watcher, changed):
+        # Waits for the burst of events to settle
+        first_event = time.monotonic()
+        while not self.controller.cancelled:
+            remaining = self.max_delay - (time.monotonic() - first_event)
+            if remaining <= 0:
+                break
+            events = watcher.wait(min(self.debounce, remaining))
+            if not events:
+                break
+            changed |= events
+        return changed
+
+    def _forget_changed(self, changed):
+        # The index can miss a change, e.g. on file systems with a coarse modification time, reported folders are read again
+        if not changed:
+            return
+        scan_index = ScanIndex(self.job.options["scan_index_file"])
+        if ALL_CHAPTERS in changed:
+            scan_index.clear()
+        else:
+            for name in changed:
+                scan_index.forget(os.path.join(self.job.input_dir, name))
+        scan_index.save()
+
+    def _build(self, changed):
+        self._forget_changed(changed)
+        summary = run_job(self.job, self.verbose, self.controller)
+        if changed:
+            summary["changed"] = sorted(changed)
+        return summary
+
+    def run(self):
+        """Yields the summary of every build, the first one right away. Runs until the controller is cancelled."""
+        # Started before the first build, files arriving while it runs are reported by the next wait
+        watcher = get_watcher(self.job.input_dir, self.poll_interval)
+        try:
+            summary = self._build(set())
+            yield summary
+
+            retry = summary["status"] == "error"
+            while not self.controller.cancelled:
+                changed = watcher.wait(self.max_delay if retry else 1.0)
+                if not changed and not retry:
+                    continue
+
+                changed = self._collect(watcher, changed)
+                if self.controller.cancelled:
+                    break
+                summary = self._build(changed)
+                retry = summary["status"] == "error"
+                yield summary
+        finally:
+            watcher.close()
@@ -1,14 +1,38 @@
-from core.img2pdf import IMG2PDF
+# ReportLab and Pillow are only imported by load_converter, so the window shows without waiting for them
+from core.jobControl import JobCancelled, JobController
 from core.validFileName import is_valid_filename
 
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
 import threading
+import multiprocessing
+import queue
+import time
 import os
 import sys
 
 
+# The worker thread never touches Tk, it posts events that the main loop drains at this interval
+EVENT_POLL_MS = 100
+MAX_CONSOLE_LINES = 1000
+# The converter is imported in the background this long after the window shows
+WARM_UP_DELAY_MS = 200
+# Size cap of the image cache, like DEFAULT_MAX_BYTES of core.imageCache, which is only imported with the converter
+DEFAULT_CACHE_MB = 2048
+
+
+def load_converter():
+    """Imports the converter, the slowest part of the startup. Returns it with the options of the window."""
+    from core.img2pdf import IMG2PDF
+    from core.imageCache import get_default_cache_dir
+    from core.pdfBuilder import preload_fonts
+
+    preload_fonts()
+    options = {"cache_dir": get_default_cache_dir(), "stream_pages": 1, "incremental": True, "prefetch": 16, "checkpoint": True}
+    return IMG2PDF, options
+
+
 class CallbackOutRedirect:
     def __init__(self, callback):
         self.callback = callback
@@ -24,11 +48,29 @@ class CallbackOutRedirect:
         self.buffer = ""
 
 
+class ProgressRate:
+    def __init__(self):
+        self.start = time.perf_counter()
+
+    def format(self, progress, image_count_total):
+        elapsed = time.perf_counter() - self.start
+        images_finished = image_count_total * progress / 100
+        if images_finished <= 0 or elapsed <= 0:
+            return ""
+
+        images_per_sec = images_finished / elapsed
+        eta = (image_count_total - images_finished) / images_per_sec
+        return f"{images_per_sec:.1f} Bilder/s, verbleibend: {int(eta // 60)}:{int(eta % 60):02d} min"
+
+
 class IMG2PDFApplication:
     def __init__(self):
         self.window = None
-        self.entry_function = IMG2PDF.run_img2pdf
+        self.entry_class = None  # IMG2PDF, set by load_converter
+        self.entry_options = None
         self.script_running = False
+        self.controller = None  # Of the running conversion
+        self.events = queue.SimpleQueue()
 
         self._build()
         self._setup_redirect()
@@ -37,25 +79,58 @@ class IMG2PDFApplication:
         sys.stdout = CallbackOutRedirect(lambda *args, **kwargs: self.print_console(*args, **kwargs, end=""))
         sys.stderr = CallbackOutRedirect(lambda *args, **kwargs: self.print_console(*args, **kwargs, end="", alert=True))
 
-    def run_script(self, dir_path_entry, dir_target_path_entry, output_name_entry, update_progress_callback):
+    def run_script(self, dir_path_entry, dir_target_path_entry, output_name_entry):
         def __inner(*args, **kwargs):
             if self.script_running:
                 print("Programm wird bereits ausgeführt!")
                 return
 
             self.script_running = True
+            try:
+                dir_path = dir_path_entry.get()
+                output_dir = dir_target_path_entry.get()
+                output_name = output_name_entry.get()
+                preview = self.preview_var.get()
+                # A preview never replaces the document, nor the chapters kept for its next run
+                output_path = os.path.join(output_dir, output_name + ("_Vorschau.pdf" if preview else ".pdf"))
+                if not self.valid_args(dir_path, output_dir, output_name):
+                    return
+                cache_max_bytes = self.get_cache_max_bytes()
+                if cache_max_bytes is None:
+                    return
+
+                self.load_converter()
+                self.controller = JobController()
+                img2pdf = self.entry_class(
+                    dir_path, output_path, scan_index_file=output_path + ".scan.json", controller=self.controller,
+                    preview=preview, cache_max_bytes=cache_max_bytes, **self.entry_options
+                )
+                try:
+                    img2pdf.create_pdf(self.update_progress(img2pdf))
+                except JobCancelled:
+                    print("Abgebrochen, erneutes Starten setzt die Erstellung fort")
+            finally:
+                self.controller = None
+                self.script_running = False
+        return __inner
 
-            dir_path = dir_path_entry.get()
-            output_dir = dir_target_path_entry.get()
-            output_name = output_name_entry.get()
-            output_path = os.path.join(output_dir, output_name + ".pdf")
-            if not self.valid_args(dir_path, output_dir, output_name):
-                return
-            # Assuming main.py has a function named 'process_file' that takes dir_path and output_name
-            self.entry_function(dir_path, output_path, update_progress_callback)
+    def load_converter(self):
+        # Concurrent calls are safe, the import lock lets the second one wait for the first
+        if self.entry_class is None:
+            converter, options = load_converter()
+            self.entry_options = options  # Set first, entry_class marks the converter as loaded
+            self.entry_class = converter
+        return self.entry_class
 
-            self.script_running = False
-        return __inner
+    def warm_up(self):
+        threading.Thread(target=self.load_converter, daemon=True).start()
+
+    def cancel_script(self):
+        if self.controller is None:
+            print("Es wird kein Programm ausgeführt")
+            return
+        print("Wird nach dem aktuellen Bild abgebrochen ...")
+        self.controller.cancel()
 
     def valid_args(self, dir_path, output_dir, output_name):
         valid_path = os.path.isdir(dir_path)
@@ -72,12 +147,45 @@ class IMG2PDFApplication:
             return False
         return True
 
-    def update_progress(self, progress_var):
+    def get_cache_max_bytes(self):
+        try:
+            cache_mb = self.cache_mb_var.get()
+        except tk.TclError:
+            cache_mb = 0
+        if cache_mb <= 0:
+            print(f"Die gewählte Cache-Größe ist ungültig: '{self.cache_mb_entry.get()}'")
+            return None
+        return cache_mb * 1024 ** 2
+
+    def update_progress(self, img2pdf):
+        rate = ProgressRate()
+
         def __inner(progress):
-            progress_var.set(progress)
-            self.window.update_idletasks()
+            # Called from the worker thread, the main loop only applies the latest value
+            self.events.put(("progress", progress, rate.format(progress, img2pdf.image_count)))
         return __inner
 
+    def _drain_events(self):
+        messages = []
+        progress = None
+        try:
+            while True:
+                event = self.events.get_nowait()
+                if event[0] == "progress":
+                    progress = event[1:]
+                else:
+                    messages.append(event[1:])
+        except queue.Empty:
+            pass
+
+        if messages:
+            self._update_console(messages)
+        if progress is not None:
+            self.progress_var.set(progress[0])
+            self.status_var.set(progress[1])
+
+        self.window.after(EVENT_POLL_MS, self._drain_events)
+
     def select_folder(self, dir_path_entry):
         def __inner():
             dir_path = filedialog.askdirectory(initialdir=os.getcwd())
@@ -86,31 +194,34 @@ class IMG2PDFApplication:
         return __inner
 
     def print_console(self, message, prefix="> ", end="\n", alert=False):
-        message = prefix + message + end
-        if alert:
-            self._update_console(message, config_tag="red_text")
-        else:
-            self._update_console(message)
+        # May be called from any thread
+        self.events.put(("console", prefix + message + end, "red_text" if alert else None))
 
-    def _update_console(self, message, config_tag=None):
+    def _update_console(self, messages):
         self.console.config(state=tk.NORMAL)  # Temporarily enable the widget to modify it
-        if config_tag is not None:
-            self.console.insert(tk.END, message, config_tag)
-        else:
-            self.console.insert(tk.END, message)
+        for message, config_tag in messages:
+            if config_tag is not None:
+                self.console.insert(tk.END, message, config_tag)
+            else:
+                self.console.insert(tk.END, message)
+
+        # Only the last lines are kept, so the console does not grow without limit
+        line_count = int(self.console.index("end-1c").split(".")[0])
+        if line_count > MAX_CONSOLE_LINES:
+            self.console.delete("1.0", f"{line_count - MAX_CONSOLE_LINES + 1}.0")
+
         self.console.see(tk.END)
         self.console.config(state=tk.DISABLED)  # Disable the widget again
 
-
     def _build(self):
         self.window = tk.Tk()
         self.window.title("Bildserie zu PDF")
 
         # Window geometry
-        self.window.geometry("800x250")
+        self.window.geometry("800x280")
         self.window.grid_columnconfigure(1, weight=10)
         self.window.grid_columnconfigure(2, weight=3)
-        self.window.grid_rowconfigure(index=6, weight=1)
+        self.window.grid_rowconfigure(index=8, weight=1)
 
         # Source Dir Path selection
         ttk.Label(self.window, text="Quellverzeichnispfad:").grid(row=0, column=0, sticky='ew', padx=10, pady=(5, 5))
@@ -129,27 +240,44 @@ class IMG2PDFApplication:
         output_name_entry = ttk.Entry(self.window, width=40)
         output_name_entry.grid(row=2, column=1, sticky="ew", pady=(0, 10))
 
+        # Quick draft of the same pages with low resolution images
+        self.preview_var = tk.BooleanVar()
+        ttk.Checkbutton(self.window, text="Vorschau", variable=self.preview_var).grid(row=2, column=2, sticky="w", padx=5, pady=(0, 10))
+
+        # Size cap of the image cache, the least recently used images are evicted first
+        ttk.Label(self.window, text="Bild-Cache (MB):").grid(row=3, column=0, sticky='ew', padx=10, pady=(0, 10))
+        self.cache_mb_var = tk.IntVar(value=DEFAULT_CACHE_MB)
+        self.cache_mb_entry = ttk.Spinbox(self.window, from_=256, to=1024 ** 2, increment=256, width=8, textvariable=self.cache_mb_var)
+        self.cache_mb_entry.grid(row=3, column=1, sticky="w", pady=(0, 10))
+
         # Horizontal separator
         separator_horizontal = ttk.Separator(self.window, orient='horizontal')
-        separator_horizontal.grid(row=3, column=0, columnspan=3, sticky="ew", padx=5)
+        separator_horizontal.grid(row=4, column=0, columnspan=3, sticky="ew", padx=5)
 
         # Run button
         ttk.Button(
             self.window,
             text="Starten",
             command=lambda: threading.Thread(
-                target=self.run_script(dir_path_entry, dir_target_path_entry, output_name_entry, self.update_progress(progress_var))
+                target=self.run_script(dir_path_entry, dir_target_path_entry, output_name_entry)
             ).start()
-        ).grid(row=4, column=0, columnspan=3, sticky="ew", padx=5)
+        ).grid(row=5, column=0, columnspan=2, sticky="ew", padx=5)
+
+        # Cancel button, completed chapters are kept for the next start
+        ttk.Button(self.window, text="Abbrechen", command=self.cancel_script).grid(row=5, column=2, sticky="ew", padx=5)
 
         # Progress Bar
-        progress_var = tk.DoubleVar()
-        progress_bar = ttk.Progressbar(self.window, maximum=100, variable=progress_var, length=200)
-        progress_bar.grid(row=5, column=0, columnspan=3, sticky="ew", padx=5)
+        self.progress_var = tk.DoubleVar()
+        progress_bar = ttk.Progressbar(self.window, maximum=100, variable=self.progress_var, length=200)
+        progress_bar.grid(row=6, column=0, columnspan=3, sticky="ew", padx=5)
+
+        # Throughput and remaining time
+        self.status_var = tk.StringVar()
+        ttk.Label(self.window, textvariable=self.status_var).grid(row=7, column=0, columnspan=3, sticky="ew", padx=5)
 
         # Console area
         self.console = tk.Text(self.window, width=50, state=tk.DISABLED)
-        self.console.grid(row=6, column=0, columnspan=3, sticky="ew", padx=5)
+        self.console.grid(row=8, column=0, columnspan=3, sticky="ew", padx=5)
         self.console.tag_configure("red_text", foreground="red")
 
     def print_intro(self):
@@ -161,10 +289,15 @@ class IMG2PDFApplication:
 
     def run(self):
         self.print_intro()
+        self.window.after(EVENT_POLL_MS, self._drain_events)
+        self.window.after(WARM_UP_DELAY_MS, self.warm_up)
         self.window.mainloop() # Blocking
 
 
 if __name__ == "__main__":
+    # Required for the image worker pool in the frozen executable
+    multiprocessing.freeze_support()
+
     app = IMG2PDFApplication()
     app.run()
 
@@ -0,0 +1,67 @@
+"""
+Local conversion service for other tools on this machine, without a cold start per conversion.
+
+    python service.py --port 8765 --workers 2
+
+The workers are started right away and stay warm between jobs. Jobs wait in a priority queue, higher first.
+The options of a job are the ones of a job manifest (see cli.py). Endpoints, all JSON:
+
+    POST   /jobs              {"input_dir", "output_file", "options", "priority"}, returns the queued job
+    GET    /jobs              all jobs known to the service
+    GET    /jobs/ID           status, progress and summary of a job
+    GET    /jobs/ID/events    the events of a job as JSON lines, streamed until it is finished
+    DELETE /jobs/ID           cancels a queued job, a running one after its current image
+    GET    /metrics           queue depth, busy workers and throughput of the last minute
+
+Jobs must be posted with Content-Type application/json and requests addressed to localhost, so a web page
+in a local browser can not submit jobs. Unknown options are rejected when the job is posted.
+The service only listens on localhost unless --host is given. With --port 0 a free port is chosen; the
+address is printed to stdout as a JSON line. Ctrl+C cancels the running jobs and stops the service.
+"""
+import argparse
+import json
+import multiprocessing
+import sys
+
+from core.conversionService import ConversionServer, ConversionService
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on, 0 picks a free one (default: 8765)")
+    parser.add_argument("--workers", type=int, default=2, help="jobs converted at the same time (default: 2)")
+    parser.add_argument("--cache-dir", help="persistent cache of prepared images, default for all jobs")
+    parser.add_argument("--cache-mb", type=int, help="size cap of the cache in MiB, default for all jobs (default: 2048)")
+    parser.add_argument("--verbose", action="store_true", help="print requests and the conversion log to stderr")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    job_options = {"cache_dir": args.cache_dir, "cache_max_bytes": args.cache_mb * 1024 ** 2 if args.cache_mb is not None else None}
+    service = ConversionService(args.workers, {k: v for k, v in job_options.items() if v is not None}, args.verbose)
+    try:
+        server = ConversionServer((args.host, args.port), service, args.verbose)
+    except OSError as e:
+        service.close()
+        print(f"Dienst kann nicht gestartet werden: {e}", file=sys.stderr)
+        return 1
+
+    host, port = server.server_address[:2]
+    print(json.dumps({"url": f"http://{host}:{port}", "workers": args.workers}), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    # Required for the worker pools in the frozen executable
+    multiprocessing.freeze_support()
+    sys.exit(main())